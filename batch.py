@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import sys
+import cv2
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import detection
+import layout
+
+
+IMAGE_SUFFIXES = {'.png', '.jpg', '.jpeg', '.bmp'}
+
+# Error written for inputs on which contours don't find exactly 10 hero portraits, so teams can't be told apart
+ROIS_NOT_FOUND = 'not exactly 10 hero portraits found'
+
+# State of a worker process, the descriptor index is loaded once per worker by init_worker
+_worker = {}
+
+
+def init_worker(path_index, matcher, matcher_options, roi_method):
+    """Loads the descriptor index and detection settings of a worker process.
+    
+    Args:
+        path_index (str): Path to the descriptor index file (created by hero-picker.py)
+        matcher (str): The matching method, has to be one of detection.MATCHERS keys
+        matcher_options (dict): Keyword arguments passed to the matcher
+        roi_method (str): Either "predefined" (scaled to the image resolution) or "contour"
+    """
+    hero_index = detection.read_hero_index(path_index)
+    if matcher == 'flann':
+        detection.build_flann_index(hero_index)
+    _worker.update(hero_index=hero_index, matcher=matcher, matcher_options=matcher_options, roi_method=roi_method)
+
+
+def crop_hero_bar(img, roi_method):
+    """Crops an image to the strip containing hero portraits.
+    
+    Args:
+        img (array): An array representing the image
+        roi_method (str): Either "predefined" (scaled to the image resolution) or "contour"
+    
+    Returns:
+        tuple(array, list[array(int)]): The cropped image and ROI polygons translated into it, ROIs are None if contours
+            didn't find exactly 10 portraits
+    """
+    if roi_method == 'contour':
+        # Ordered like the predefined ROIs, so the first five are dire and the rest radiant
+        rois = layout.calibrate(img)
+        if rois is None:
+            return img, None
+    else:
+        rois = layout.scale_rois(detection.predefined_rois(), img.shape[1], img.shape[0])
+    if not rois:
+        return img, rois
+
+    x, y, w, h = detection.rois_bounding_rect(rois)
+    return img[y: y + h, x: x + w], detection.translate_rois(rois, x, y)
+
+
+def detect(img, rois):
+    """Detects heroes on an image in a worker process.
+    
+    Args:
+        img (array): An array representing the image
+        rois (list[array(int)]): List of ROI polygons for coordinates of heroes' portraits
+    
+    Returns:
+        dict: IDs of detected heroes (None if not found) and their match scores for each team
+    """
+    best_matches = detection.match_heroes(img, rois, _worker['hero_index'], _worker['matcher'],
+                                          matcher_options=_worker['matcher_options'])
+    hero_ids = [hero_id if count > detection.MATCH_THRESHOLD else None for hero_id, count, matched in best_matches]
+    scores = [count for hero_id, count, matched in best_matches]
+    return {
+        'radiant': hero_ids[5:],
+        'dire': hero_ids[:5],
+        'radiant_scores': scores[5:],
+        'dire_scores': scores[:5],
+    }
+
+
+def detect_file(path):
+    """Detects heroes on a screenshot file in a worker process.
+    
+    Args:
+        path (str): Path to the screenshot
+    
+    Returns:
+        dict: File name and the detected heroes (see detect function)
+    """
+    img = cv2.imread(str(path))
+    if img is None:
+        return {'source': Path(path).name, 'error': 'unreadable image'}
+    img, rois = crop_hero_bar(img, _worker['roi_method'])
+    if rois is None:
+        return {'source': Path(path).name, 'error': ROIS_NOT_FOUND}
+    return {'source': Path(path).name, **detect(img, rois)}
+
+
+def detect_frame(task):
+    """Detects heroes on a video frame in a worker process.
+    
+    Args:
+        task (tuple(int, float, array, list[array(int)])): Frame number, timestamp in seconds, the frame
+            (cropped to the hero portraits) and the ROI polygons (None to find them in the worker)
+    
+    Returns:
+        dict: Frame number, timestamp and the detected heroes (see detect function)
+    """
+    frame_number, timestamp, img, rois = task
+    if rois is None:
+        img, rois = crop_hero_bar(img, _worker['roi_method'])
+        if rois is None:
+            return {'frame': frame_number, 'timestamp': round(timestamp, 3), 'error': ROIS_NOT_FOUND}
+    return {'frame': frame_number, 'timestamp': round(timestamp, 3), **detect(img, rois)}
+
+
+def read_video(path, every, roi_method):
+    """Reads every n-th frame of a video. Skipped frames are only grabbed, not decoded. With predefined ROIs the frames
+    are cropped to the hero portraits here, so only small strips are sent to the worker processes.
+    
+    Args:
+        path (str): Path to the video file
+        every (int): Only every n-th frame is returned
+        roi_method (str): Either "predefined" (scaled to the frame resolution) or "contour"
+    
+    Yields:
+        tuple(int, float, array, list[array(int)]): Tasks for detect_frame function
+    """
+    cap = cv2.VideoCapture(str(path))
+    if not cap.isOpened():
+        sys.exit(f'Could not open video {path}')
+    fps = cap.get(cv2.CAP_PROP_FPS)
+
+    frame_number = 0
+    layouts = {}
+    try:
+        while True:
+            if frame_number % every:
+                if not cap.grab():
+                    break
+            else:
+                ok, frame = cap.read()
+                if not ok:
+                    break
+                timestamp = frame_number / fps if fps > 0 else cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+                if roi_method == 'contour':
+                    yield frame_number, timestamp, frame, None
+                else:
+                    # The resolution doesn't change within a video, so ROIs are computed once
+                    if frame.shape not in layouts:
+                        rois = layout.scale_rois(detection.predefined_rois(), frame.shape[1], frame.shape[0])
+                        region = detection.rois_bounding_rect(rois)
+                        layouts[frame.shape] = (region, detection.translate_rois(rois, region[0], region[1]))
+                    (x, y, w, h), rois = layouts[frame.shape]
+                    yield frame_number, timestamp, frame[y: y + h, x: x + w].copy(), rois
+            frame_number += 1
+    finally:
+        cap.release()
+
+
+def ordered_map(executor, fn, tasks, window):
+    """Maps tasks on an executor while keeping at most the given number of tasks in flight. Results are yielded in task order.
+    
+    Args:
+        executor (concurrent.futures.Executor): Executor running the tasks
+        fn (function): Function applied to each task
+        tasks (iterable): Tasks (possibly a lazy generator)
+        window (int): Maximal number of submitted but not yet yielded tasks
+    
+    Yields:
+        Any: Result of each task
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(fn, task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Detects heroes on a folder of screenshots or a recorded video and writes the results as JSON lines.')
+    parser.add_argument('input', help='folder of screenshots or a video file')
+    parser.add_argument('--output', help='output file, by default the results are written to standard output')
+    parser.add_argument('--every', type=int, default=1, help='process only every n-th frame (or screenshot)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes')
+    parser.add_argument('--index', help='descriptor index of hero portraits (created by hero-picker.py), by default the one '
+                                         'of the feature type in the config')
+    parser.add_argument('--matcher', choices=list(detection.MATCHERS), help='matching method, by default taken from the config')
+    parser.add_argument('--roi-method', choices=['predefined', 'contour'], default='predefined',
+                        help='"predefined" coordinates are scaled to the resolution of each input')
+    args = parser.parse_args()
+
+    path_config = Path(__file__).resolve().with_name('config.json')
+    with open(path_config, 'r', encoding='utf-8') as fp:
+        config_image = json.load(fp)['image']
+    path_index = args.index or str(Path(__file__).resolve().with_name(f'hero_index_{config_image["features"]}.npz'))
+    if not Path(path_index).exists():
+        sys.exit(f'Descriptor index {path_index} not found, run hero-picker.py once to create it')
+    matcher = args.matcher or config_image['matcher']
+    matcher_options = config_image.get(matcher)
+
+    path_input = Path(args.input)
+    if path_input.is_dir():
+        files = sorted(path for path in path_input.iterdir() if path.suffix.lower() in IMAGE_SUFFIXES)
+        fn, tasks = detect_file, files[::args.every]
+    else:
+        fn, tasks = detect_frame, read_video(path_input, args.every, args.roi_method)
+
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                 initargs=(path_index, matcher, matcher_options, args.roi_method)) as executor:
+            for result in ordered_map(executor, fn, tasks, args.workers * 4):
+                out.write(json.dumps(result) + '\n')
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
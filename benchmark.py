@@ -0,0 +1,229 @@
+import argparse
+import json
+import sys
+import time
+import cv2
+import numpy as np
+from pathlib import Path
+
+import detection
+import layout
+
+
+def load_local_heroes(path_images):
+    """Creates hero information from the portraits in the images folder, so detection can run without querying Stratz.
+    Heroes get consecutive IDs in the order of their names.
+    
+    Args:
+        path_images (str): Path to the folder containing images of heroes
+    
+    Returns:
+        json: Hero information in the format of queries.make_hero_info_query results
+    """
+    names = sorted(path.stem for path in Path(path_images).glob('*.png'))
+    heroes = [{'id': i + 1, 'name': name, 'shortName': name, 'displayName': name} for i, name in enumerate(names)]
+    return {'constants': {'heroes': heroes}}
+
+
+def make_sample(portraits, rois, rng, scale=1.0, noise=0.0, occlusion=0.0, size=(1080, 1920)):
+    """Creates a synthetic pick phase image by compositing random hero portraits into the ROI slots.
+    
+    Args:
+        portraits (dict{int: array}): Portrait image for each hero ID
+        rois (list[array(int)]): List of ROI polygons of the slots
+        rng (numpy.random.Generator): Random generator
+        scale (float, optional): Size of the portraits relative to their slot
+        noise (float, optional): Standard deviation of the Gaussian noise added to the portraits
+        occlusion (float, optional): Fraction of each slot covered by a rectangle of random colour
+        size (tuple(int, int), optional): Height and width of the image
+    
+    Returns:
+        tuple(array, list[int]): The image and the ID of the hero in each slot
+    """
+    img = np.full((size[0], size[1], 3), 24, np.uint8)
+    hero_ids = rng.choice(list(portraits), size=len(rois), replace=False).tolist()
+
+    for roi, hero_id in zip(rois, hero_ids):
+        x, y, w, h = detection.rois_bounding_rect([roi])
+
+        # Scale the portrait around the slot's center, cropping whatever doesn't fit
+        sw, sh = max(1, round(w * scale)), max(1, round(h * scale))
+        portrait = cv2.resize(portraits[hero_id], (sw, sh), interpolation=cv2.INTER_AREA)
+        ox, oy = (w - sw) // 2, (h - sh) // 2
+        dx, dy, sx, sy = max(ox, 0), max(oy, 0), max(-ox, 0), max(-oy, 0)
+        cw, ch = min(w - dx, sw - sx), min(h - dy, sh - sy)
+        slot = np.zeros((h, w, 3), np.uint8)
+        slot[dy: dy + ch, dx: dx + cw] = portrait[sy: sy + ch, sx: sx + cw]
+
+        if occlusion > 0:
+            ow, oh = round(w * np.sqrt(occlusion)), round(h * np.sqrt(occlusion))
+            ox, oy = rng.integers(0, w - ow + 1), rng.integers(0, h - oh + 1)
+            slot[oy: oy + oh, ox: ox + ow] = rng.integers(0, 256, 3)
+
+        if noise > 0:
+            slot = np.clip(slot + rng.normal(0, noise, slot.shape), 0, 255).astype(np.uint8)
+
+        mask = np.zeros((h, w), np.uint8)
+        cv2.fillPoly(mask, pts=[(roi - np.array([x, y], dtype=roi.dtype)).astype(np.int32)], color=255)
+        view = img[y: y + h, x: x + w]
+        view[mask > 0] = slot[mask > 0]
+
+    return img, hero_ids
+
+
+def run_matcher(hero_index, samples, rois, matcher, matcher_options=None, workers=1):
+    """Detects heroes on every sample with the given matcher, measuring the duration of each stage.
+    
+    Args:
+        hero_index (dict): Descriptor index of hero portraits (obtained through detection.build_hero_index)
+        samples (list[tuple(array, list[int])]): Images and their hero IDs (obtained through make_sample function)
+        rois (list[array(int)]): List of ROI polygons of the slots
+        matcher (str): The matching method, has to be one of detection.MATCHERS keys
+        matcher_options (dict, optional): Keyword arguments passed to the matcher
+        workers (int, optional): Number of threads matching the ROIs
+    
+    Returns:
+        dict: Durations of each stage in seconds ("timings"), detected heroes ("detected"), the number of
+            correct, wrong and not found heroes and the number of heroes compared to each portrait ("compared")
+    """
+    timings = {}
+    # Every matcher starts without heroes remembered from the previous runs
+    hero_index.pop('recent', None)
+
+    # Shared matcher state is built once per process, measure it separately from the detections
+    start = time.perf_counter()
+    if matcher == 'flann' and 'flann' not in hero_index:
+        detection.build_flann_index(hero_index)
+    timings['prepare'] = [time.perf_counter() - start]
+
+    timings['total'] = []
+    result = {'timings': timings, 'detected': [], 'correct': 0, 'wrong': 0, 'not_found': 0, 'compared': []}
+    for img, truth in samples:
+        start = time.perf_counter()
+        best_matches = detection.match_heroes(img, rois, hero_index, matcher, workers, matcher_options, timings)
+        timings['total'].append(time.perf_counter() - start)
+
+        detected = [hero_id if count > detection.MATCH_THRESHOLD else None for hero_id, count, compared in best_matches]
+        result['detected'].append(detected)
+        result['compared'].extend(compared for hero_id, count, compared in best_matches)
+        for hero_id, true_id in zip(detected, truth):
+            if hero_id is None:
+                result['not_found'] += 1
+            elif hero_id == true_id:
+                result['correct'] += 1
+            else:
+                result['wrong'] += 1
+
+    return result
+
+
+def print_table(header, rows):
+    """Prints a table, each column is as wide as its widest value and columns are separated by two spaces.
+    
+    Args:
+        header (list[str]): Name of each column
+        rows (list[list[str]]): Values of each row, rows may have fewer values than columns
+    """
+    widths = [max(len(row[col]) for row in [header] + rows if col < len(row)) for col in range(len(header))]
+    for row in [header] + rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+
+def print_report(results):
+    """Prints latency percentiles of each stage and the accuracy of each backend (feature type and matcher).
+    Backends are also compared to the exhaustive Brute-Force matcher of the same feature type, if it was run.
+    
+    Args:
+        results (dict{str: dict}): Results for each backend (obtained through run_matcher function)
+    """
+    stages = ['extract', 'describe', 'match', 'total']
+    print('Latency in ms (p50 / p90 / p99), stages are per portrait, total is per image')
+    rows = []
+    for backend, result in results.items():
+        row = [backend]
+        for stage in stages:
+            p50, p90, p99 = np.percentile(np.array(result['timings'][stage]) * 1000, [50, 90, 99])
+            row.append(f'{p50:.2f} / {p90:.2f} / {p99:.2f}')
+        row.append(f'{result["timings"]["prepare"][0] * 1000:.2f}')
+        rows.append(row)
+    print_table(['backend'] + stages + ['prepare'], rows)
+
+    print()
+    rows = []
+    for backend, result in results.items():
+        total = result['correct'] + result['wrong'] + result['not_found']
+        row = [
+            backend,
+            f'{result["correct"] / total:.1%}',
+            f'{result["wrong"] / total:.1%}',
+            f'{result["not_found"] / total:.1%}',
+            f'{np.mean(result["compared"]):.1f}',
+        ]
+
+        exhaustive = results.get(backend.split('+')[0] + '+bf')
+        if exhaustive is not None:
+            same = sum(hero_id == bf_id for detected, bf_detected in zip(result['detected'], exhaustive['detected'])
+                       for hero_id, bf_id in zip(detected, bf_detected))
+            row.append(f'{same / total:.1%}')
+        rows.append(row)
+    print_table(['backend', 'top-1', 'wrong', 'not found', 'compared', 'same as bf'], rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks hero detection on synthetic pick phase images.')
+    parser.add_argument('--images', default=str(Path(__file__).resolve().with_name('images')),
+                        help='folder containing hero portraits')
+    parser.add_argument('--samples', type=int, default=20, help='number of synthetic images')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--scale', type=float, default=1.0, help='portrait size relative to its slot')
+    parser.add_argument('--noise', type=float, default=0.0, help='standard deviation of Gaussian noise')
+    parser.add_argument('--occlusion', type=float, default=0.0, help='fraction of each portrait that is covered')
+    parser.add_argument('--features', nargs='+', default=['sift'], choices=list(detection.FEATURES))
+    parser.add_argument('--matchers', nargs='+', default=list(detection.MATCHERS), choices=list(detection.MATCHERS))
+    parser.add_argument('--workers', type=int, default=1, help='number of threads matching the portraits')
+    parser.add_argument('--min-accuracy', type=float, default=0.0,
+                        help='exit with an error if the top-1 accuracy of any matcher is lower')
+    args = parser.parse_args()
+
+    # Matcher options are taken from the config, if there is one
+    config_image = {}
+    path_config = Path(__file__).resolve().with_name('config.json')
+    if path_config.exists():
+        with open(path_config, 'r', encoding='utf-8') as fp:
+            config_image = json.load(fp)['image']
+
+    heroes = load_local_heroes(args.images)
+    if not heroes['constants']['heroes']:
+        sys.exit(f'No hero portraits in {args.images}')
+
+    portraits = {}
+    for hero in heroes['constants']['heroes']:
+        portraits[hero['id']] = cv2.imread(str(Path(args.images, hero['shortName'] + '.png')))
+
+    rng = np.random.default_rng(args.seed)
+    rois = layout.scale_rois(detection.predefined_rois(), layout.BASE_WIDTH, layout.BASE_HEIGHT)
+    samples = [make_sample(portraits, rois, rng, args.scale, args.noise, args.occlusion) for i in range(args.samples)]
+    print(f'Created {len(samples)} samples (scale {args.scale}, noise {args.noise}, occlusion {args.occlusion})')
+    print()
+
+    results = {}
+    for features in args.features:
+        start = time.perf_counter()
+        checksum = detection.portraits_checksum(heroes, args.images, features)
+        hero_index = detection.build_hero_index(heroes, args.images, checksum, features)
+        print(f'Built {features} descriptor index of {len(hero_index["descriptors"])} heroes in {time.perf_counter() - start:.2f} s')
+
+        for matcher in args.matchers:
+            results[f'{features}+{matcher}'] = run_matcher(hero_index, samples, rois, matcher,
+                                                           config_image.get(matcher), args.workers)
+    print()
+    print_report(results)
+
+    for backend, result in results.items():
+        total = result['correct'] + result['wrong'] + result['not_found']
+        if result['correct'] / total < args.min_accuracy:
+            sys.exit(f'Accuracy of {backend} is below {args.min_accuracy:.1%}')
+
+
+if __name__ == '__main__':
+    main()
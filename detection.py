@@ -1,12 +1,63 @@
 import cv2
+import hashlib
+import os
+import time
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from mss import mss
 from matplotlib import pyplot as plt
 from pathlib import Path
 
+import ranking
+from misc import Error
+
+
+# Bump whenever the layout of the saved index or the feature extraction changes
+INDEX_VERSION = 4
+
+# Lowe's ratio test threshold and the minimal number of good matches to accept a hero
+RATIO_THRESHOLD = 0.7
+MATCH_THRESHOLD = 10
+
+# Number of nearest neighbours queried from the FLANN index for each ROI descriptor
+FLANN_KNN = 10
+
+# Hue and saturation bins of the colour histograms used as cheap portrait signatures
+SIGNATURE_BINS = [16, 8]
+
+# Local feature types: the function creating the extractor, descriptor size and type, and whether descriptors are binary.
+# Extractors are looked up only when created, so a backend missing from the installed OpenCV only fails when it's used
+FEATURES = {
+    'sift': (lambda: cv2.SIFT_create(), 128, np.float32, False),
+    # Portraits are small, so ORB's border and patch size are reduced from 31 to keep enough keypoints
+    'orb': (lambda: cv2.ORB_create(nfeatures=500, edgeThreshold=15, patchSize=15), 32, np.uint8, True),
+    # Likewise AKAZE's detector threshold is lowered from 0.001, which finds almost no keypoints on portrait sized images
+    'akaze': (lambda: cv2.AKAZE_create(threshold=0.0001), 61, np.uint8, True),
+}
+
+
+def create_extractor(features):
+    """Creates a local feature extractor.
+    
+    Args:
+        features (str): Type of local features, has to be one of FEATURES keys
+    
+    Returns:
+        cv2.Feature2D: The extractor
+    
+    Raises:
+        Error: Error indicating the installed OpenCV doesn't provide the feature type
+    """
+    try:
+        return FEATURES[features][0]()
+    except AttributeError:
+        raise Error(f'Feature type "{features}" is not available in the installed OpenCV {cv2.__version__}, '
+                    f'choose another one in config.json')
+
 
 def get_hero_rois(img):
     """Get ROI polygons of hero portraits from an image during hero pick phase using contours.
+    The expected portrait size is scaled from full HD to the image's height.
     
     Args:
         img (array): An array representing the image (obtained through make_screenshot function)
@@ -14,7 +65,8 @@ def get_hero_rois(img):
     Returns:
         list[array(int)]: List of ROI polygons, which are arrays of 2D points
     """
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    scale = img.shape[0] / 1080
+    gray = cv2.cvtColor(img, cv2.COLOR_BGRA2GRAY if img.shape[2] == 4 else cv2.COLOR_BGR2GRAY)
     blurred = cv2.GaussianBlur(gray, (5, 5), 0)
     edges = cv2.Canny(blurred, 1, 15)
 
@@ -26,28 +78,32 @@ def get_hero_rois(img):
     # Find contours
     contours, hierarchy = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
+    # Expected area of a portrait
+    cont_area = 8600 * scale ** 2
+    cont_area_eps = 100 * scale ** 2
+
     # Filter contours
     rois = [] 
     for contour in contours:
         # Based on Y coodinates of contour
-        if contour[0][0][1] > 80:
+        if contour[0][0][1] > 80 * scale:
             continue
-        cv2.drawContours(img, [contour], 0, (0, 255, 0), 1)
 
         # Approximate the contour to a polygon
         epsilon = 0.1 * cv2.arcLength(contour, True)
         polygon = cv2.approxPolyDP(contour, epsilon, True)
-        
-        # Check area
-        cont_area = 8600
-        cont_area_eps = 100
+        if len(polygon) != 4:
+            continue
 
-        area_correct = np.abs(cv2.contourArea(polygon) - cont_area) < 100
+        # Check area
+        area = cv2.contourArea(polygon)
+        area_correct = np.abs(area - cont_area) < cont_area_eps
 
-        # Check if the polygon has 4 sides and the aspect ratio is close to 1 
-        aspect_correct = abs(1 - cv2.contourArea(polygon) / (cv2.boundingRect(polygon)[2] * cv2.boundingRect(polygon)[3])) < 0.2
+        # Check if the aspect ratio is close to 1 
+        rect = cv2.boundingRect(polygon)
+        aspect_correct = abs(1 - area / (rect[2] * rect[3])) < 0.2
 
-        if len(polygon) == 4 and area_correct and aspect_correct:
+        if area_correct and aspect_correct:
             rois.append(polygon)
 
     return rois
@@ -82,100 +138,581 @@ def predefined_rois():
     return rois
 
 
-def detect_heroes(heroes, img, rois, path_images):
-    """Returns a list of heroes from an image given hero portrait positions. Each portrait is compared to the images of hero in the given folder.
-    The image comparison is done using OpenCV's Brute-Force matcher of SIFT features.
+def portraits_checksum(heroes, path_images, features='sift'):
+    """Computes a checksum identifying the hero portraits (and the index version and feature type) a descriptor index is built from.
     
     Args:
         heroes (json): JSON object containing constant data of each hero (obtained through queries.make_hero_info_query function)
-        img (array): An array representing the image (obtained through make_screenshot function)
-        rois (list[array(int)]): List of ROI polygons for coordinates of heroes' portraits
         path_images (str): Path to the folder containing images of heroes
-
+        features (str, optional): Type of local features, has to be one of FEATURES keys
     
     Returns:
-        list[int]: List of detected heroes' IDs
+        str: Hex digest of the index version, feature type, hero IDs and the content of each portrait
     """
-    hero_names = {}
+    sha = hashlib.sha1(f'version {INDEX_VERSION} {features}'.encode())
     for hero in heroes['constants']['heroes']:
-        hero_names[hero['id']] = hero['shortName']
+        hero_id, hero_name = hero['id'], hero['shortName']
+        sha.update(f'{hero_id} {hero_name}'.encode())
+        filename = Path(path_images, hero_name + '.png')
+        if filename.exists():
+            sha.update(filename.read_bytes())
+    return sha.hexdigest()
 
-    bf = cv2.BFMatcher()
-    sift = cv2.SIFT_create()
 
+def color_signature(img, mask=None):
+    """Computes a cheap colour signature of an image, a square rooted and normalized hue-saturation histogram.
+    The dot product of two signatures is their Bhattacharyya coefficient (1 for identical histograms).
+    
+    Args:
+        img (array): An array representing the image
+        mask (array, optional): Mask of the pixels to include
+    
+    Returns:
+        array: Signature of the image
+    """
+    if img.shape[2] == 4:
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([hsv], [0, 1], mask, SIGNATURE_BINS, [0, 180, 0, 256]).ravel()
+    total = hist.sum()
+    return np.sqrt(hist / total) if total > 0 else hist
+
+
+def build_hero_index(heroes, path_images, checksum, features='sift'):
+    """Extracts local feature descriptors and colour signatures of each hero portrait in the given folder.
+    
+    Args:
+        heroes (json): JSON object containing constant data of each hero (obtained through queries.make_hero_info_query function)
+        path_images (str): Path to the folder containing images of heroes
+        checksum (str): Checksum of the portraits (obtained through portraits_checksum function)
+        features (str, optional): Type of local features, has to be one of FEATURES keys
+    
+    Returns:
+        dict: Descriptor index containing the checksum, the feature type, the descriptors (array) for each hero ID and the colour signatures of heroes (in the same order)
+    """
+    des_size, des_type, binary = FEATURES[features][1:]
+    extractor = create_extractor(features)
     hero_des = {}
+    signatures = []
 
     for hero in heroes['constants']['heroes']:
         hero_name = hero['shortName']
         filename = Path(path_images, hero_name + '.png')
         img_hero = cv2.imread(str(filename))
-        kp, des = sift.detectAndCompute(img_hero, None)
+        kp, des = extractor.detectAndCompute(img_hero, None)
+        if des is None:
+            des = np.zeros((0, des_size), des_type)
         hero_des[hero['id']] = des
+        signatures.append(color_signature(img_hero))
 
-    matched_heroes = []
+    return {'checksum': checksum, 'features': features, 'descriptors': hero_des, 'signatures': np.array(signatures, np.float32)}
 
-    # Compare each roi to loaded images based on SIFT
-    for roi in rois:
-        mask = np.zeros(img.shape[:2], np.uint8)
-        cv2.fillPoly(mask, pts=[roi], color=(255, 255, 255))
-        masked_img = cv2.bitwise_and(img,img,mask = mask)
-        rect = cv2.boundingRect(roi)
-        cropped = masked_img[rect[1]: rect[1] + rect[3], rect[0]: rect[0] + rect[2]]
-        kp, des = sift.detectAndCompute(cropped, None)
 
-        hero_matches = []
+def save_hero_index(path_index, hero_index):
+    """Saves the descriptor index to disk as a single NumPy archive.
+    
+    Args:
+        path_index (str): Path to the index file
+        hero_index (dict): Descriptor index (obtained through build_hero_index function)
+    """
+    hero_ids = list(hero_index['descriptors'])
+    des_list = [hero_index['descriptors'][hero_id] for hero_id in hero_ids]
+
+    # Write to a temporary file first so an interrupted save never leaves a corrupt index behind
+    path_tmp = str(path_index) + '.tmp'
+    with open(path_tmp, 'wb') as fp:
+        np.savez(fp,
+                 checksum=np.array(hero_index['checksum']),
+                 features=np.array(hero_index['features']),
+                 hero_ids=np.array(hero_ids, np.int32),
+                 counts=np.array([len(des) for des in des_list], np.int32),
+                 descriptors=np.concatenate(des_list),
+                 signatures=hero_index['signatures'])
+    os.replace(path_tmp, path_index)
+
+
+def read_hero_index(path_index):
+    """Reads a descriptor index saved by save_hero_index.
+    
+    Args:
+        path_index (str): Path to the index file
+    
+    Returns:
+        dict: Descriptor index containing the checksum, the feature type, the descriptors (array) for each hero ID and the colour signatures of heroes (in the same order)
+    """
+    with np.load(path_index) as data:
+        checksum = str(data['checksum'])
+        features = str(data['features'])
+        hero_ids = data['hero_ids'].tolist()
+        des_list = np.split(data['descriptors'], np.cumsum(data['counts'])[:-1])
+        signatures = data['signatures']
+
+    return {'checksum': checksum, 'features': features, 'descriptors': dict(zip(hero_ids, des_list)), 'signatures': signatures}
+
+
+def load_hero_index(heroes, path_images, path_index, features='sift'):
+    """Loads the descriptor index of hero portraits from disk. The index is (re)built and saved if it doesn't exist yet
+    or the portraits it was built from have changed.
+    
+    Args:
+        heroes (json): JSON object containing constant data of each hero (obtained through queries.make_hero_info_query function)
+        path_images (str): Path to the folder containing images of heroes
+        path_index (str): Path to the index file, each feature type should have its own file
+        features (str, optional): Type of local features, has to be one of FEATURES keys
+    
+    Returns:
+        dict: Descriptor index containing the checksum, the feature type, the descriptors (array) for each hero ID and the colour signatures of heroes (in the same order)
+    """
+    checksum = portraits_checksum(heroes, path_images, features)
+
+    if Path(path_index).exists():
+        try:
+            hero_index = read_hero_index(path_index)
+            if hero_index['checksum'] == checksum:
+                return hero_index
+        except (OSError, ValueError, KeyError):
+            pass
+
+    print(f'Building hero descriptor index ({features})...')
+    hero_index = build_hero_index(heroes, path_images, checksum, features)
+    save_hero_index(path_index, hero_index)
+    return hero_index
 
-        for hero in heroes['constants']['heroes']:
-            hero_id = hero['id']
-            des_target = hero_des[hero_id]
 
+def iter_bf_matches(des, hero_index, hero_ids):
+    """Lazily counts good feature matches between ROI descriptors and each given hero's descriptors using a Brute-Force matcher
+    (L2 distance for SIFT, Hamming distance for binary descriptors).
+    
+    Args:
+        des (array): Descriptors of the ROI
+        hero_index (dict): Descriptor index of hero portraits (obtained through load_hero_index function)
+        hero_ids (iterable[int]): IDs of heroes to match against, in order
+    
+    Yields:
+        tuple(int, int): Hero ID and the number of matches passing the ratio test
+    """
+    binary = FEATURES[hero_index['features']][3]
+    bf = cv2.BFMatcher(cv2.NORM_HAMMING if binary else cv2.NORM_L2)
+
+    for hero_id in hero_ids:
+        des_target = hero_index['descriptors'][hero_id]
+        matches_count = 0
+        if des is not None and len(des_target) >= 2:
             matches = bf.knnMatch(des, des_target, k=2)
-            matches_count = 0
             for m, n in matches:
-                if m.distance < 0.7 * n.distance:
+                if m.distance < RATIO_THRESHOLD * n.distance:
                     matches_count += 1
-            hero_matches.append((hero_id, matches_count))
-        hero_matches = sorted(hero_matches, key=lambda x: x[1], reverse=True)
-        matched = hero_matches[0][0] if hero_matches[0][1] > 10 else None
+        yield hero_id, matches_count
+
+
+def match_bf(des, hero_index, cropped=None, hero_ids=None):
+    """Counts good feature matches between ROI descriptors and each hero's descriptors using a Brute-Force matcher per hero
+    (L2 distance for SIFT, Hamming distance for binary descriptors).
+    
+    Args:
+        des (array): Descriptors of the ROI
+        hero_index (dict): Descriptor index of hero portraits (obtained through load_hero_index function)
+        cropped (array, optional): The cropped portrait, unused
+        hero_ids (list[int], optional): IDs of heroes to match against, by default all heroes in the index
+    
+    Returns:
+        list[tuple(int, int)]: Hero ID and the number of matches passing the ratio test for each hero
+    """
+    if hero_ids is None:
+        hero_ids = hero_index['descriptors']
+    return list(iter_bf_matches(des, hero_index, hero_ids))
+
+
+def build_flann_index(hero_index):
+    """Puts the descriptors of all heroes into a single FLANN index with a hero ID label for each row. SIFT descriptors
+    are indexed by KD-trees, binary descriptors by locality sensitive hashing (Hamming distance).
+    The index is stored in the descriptor index under the "flann" and "labels" keys.
+    
+    Args:
+        hero_index (dict): Descriptor index of hero portraits (obtained through load_hero_index function)
+    """
+    hero_ids = list(hero_index['descriptors'])
+    des_list = [hero_index['descriptors'][hero_id] for hero_id in hero_ids]
+    labels = np.repeat(np.array(hero_ids, np.int32), [len(des) for des in des_list])
+
+    if FEATURES[hero_index['features']][3]:
+        params = {'algorithm': 6, 'table_number': 6, 'key_size': 12, 'multi_probe_level': 1}
+    else:
+        params = {'algorithm': 1, 'trees': 4}
+    hero_index['flann'] = cv2.flann_Index(np.concatenate(des_list), params)
+    hero_index['labels'] = labels
+
+
+def match_flann(des, hero_index, cropped=None):
+    """Counts good feature matches between ROI descriptors and each hero's descriptors using one kNN query of the FLANN index.
+    Each ROI descriptor votes for every hero among its nearest neighbours that passes the ratio test against that hero's
+    second nearest descriptor, which keeps the counts comparable to match_bf. When the second descriptor of a hero is not
+    among the neighbours, the farthest neighbour is used instead, so the test is never more permissive than match_bf.
+    
+    Args:
+        des (array): Descriptors of the ROI
+        hero_index (dict): Descriptor index of hero portraits (obtained through load_hero_index function)
+        cropped (array, optional): The cropped portrait, unused
+    
+    Returns:
+        list[tuple(int, int)]: Hero ID and the number of matches passing the ratio test for each hero
+    """
+    if 'flann' not in hero_index:
+        build_flann_index(hero_index)
+
+    votes = dict.fromkeys(hero_index['descriptors'], 0)
+    if des is None or len(des) == 0:
+        return list(votes.items())
+
+    knn = min(FLANN_KNN, len(hero_index['labels']))
+    idx, dist = hero_index['flann'].knnSearch(des, knn, params={'checks': 32})
+    # KD-tree index returns squared L2 distances, LSH index returns Hamming distances
+    if not FEATURES[hero_index['features']][3]:
+        dist = np.sqrt(dist)
+    labels = hero_index['labels'][idx]
+
+    for row_idx, row_labels, row_dist in zip(idx.tolist(), labels.tolist(), dist.tolist()):
+        # LSH may find fewer neighbours than requested, missing ones have negative indexes
+        row = [(label, d) for i, label, d in zip(row_idx, row_labels, row_dist) if i >= 0]
+        if not row:
+            continue
+        first, second = {}, {}
+        for label, d in row:
+            if label not in first:
+                first[label] = d
+            elif label not in second:
+                second[label] = d
+        for label, d in first.items():
+            if d < RATIO_THRESHOLD * second.get(label, row[-1][1]):
+                votes[label] += 1
+
+    return list(votes.items())
+
+
+def match_cascade(des, hero_index, cropped, top_k=5, min_matches=20):
+    """Ranks heroes by the similarity of their colour signatures to the portrait and counts good feature matches only for the top candidates.
+    If none of the candidates reaches the given number of matches, the remaining heroes are matched as well.
+    
+    Args:
+        des (array): Descriptors of the ROI
+        hero_index (dict): Descriptor index of hero portraits (obtained through load_hero_index function)
+        cropped (array): The cropped portrait (obtained through extract_roi function)
+        top_k (int, optional): Number of candidates matched with local features, at least one is matched
+        min_matches (int, optional): Matches the best candidate needs, otherwise all heroes are matched
+    
+    Returns:
+        list[tuple(int, int)]: Hero ID and the number of matches passing the ratio test for each matched hero
+    """
+    hero_ids = list(hero_index['descriptors'])
+
+    mask = cropped.max(axis=2) if cropped.ndim == 3 else cropped
+    mask = (mask > 0).astype(np.uint8)
+    similarity = hero_index['signatures'] @ color_signature(cropped, mask)
+    order = ranking.top_k_indices(similarity, max(1, top_k))
+    candidates = [hero_ids[i] for i in order]
+
+    hero_matches = match_bf(des, hero_index, hero_ids=candidates)
+    if max((count for hero_id, count in hero_matches), default=0) >= min_matches:
+        return hero_matches
+
+    candidates = set(candidates)
+    rest = [hero_id for hero_id in hero_ids if hero_id not in candidates]
+    return hero_matches + match_bf(des, hero_index, hero_ids=rest)
+
+
+def match_early_exit(des, hero_index, cropped=None, hints=None, ratio=3.0, min_compared=5):
+    """Counts good feature matches with a Brute-Force matcher, trying likely heroes first and stopping as soon as one of them
+    is matched confidently. Heroes detected recently (see match_heroes function) are tried first, then the given hints
+    (e.g. meta heroes), then the rest. If no hero clears the threshold, every hero is matched like match_bf does.
+    A hero is confident when it has more than MATCH_THRESHOLD matches and ratio times more than the runner-up among the heroes
+    compared so far. The ratio doesn't depend on how many matches a feature type produces (ORB matches far more than SIFT).
+    
+    Args:
+        des (array): Descriptors of the ROI
+        hero_index (dict): Descriptor index of hero portraits (obtained through load_hero_index function)
+        cropped (array, optional): The cropped portrait, unused
+        hints (list[int], optional): IDs of heroes likely to be picked
+        ratio (float, optional): How many times more matches than the runner-up the best hero needs to stop early
+        min_compared (int, optional): Number of heroes compared before the search can stop, so the runner-up is meaningful
+    
+    Returns:
+        list[tuple(int, int)]: Hero ID and the number of matches passing the ratio test for each matched hero
+    """
+    hero_ids = list(hero_index['descriptors'])
+    order = list(dict.fromkeys(hero_index.get('recent', []) + list(hints or []) + hero_ids))
+
+    hero_matches = []
+    best = runner_up = 0
+    for hero_id, matches_count in iter_bf_matches(des, hero_index, (hero_id for hero_id in order if hero_id in hero_index['descriptors'])):
+        hero_matches.append((hero_id, matches_count))
+        if matches_count > best:
+            best, runner_up = matches_count, best
+        elif matches_count > runner_up:
+            runner_up = matches_count
+        if len(hero_matches) >= min_compared and best > MATCH_THRESHOLD and best >= ratio * max(runner_up, 1):
+            return hero_matches
+
+    # Nothing is confident, keep the index order so ties are broken like in match_bf
+    counts = dict(hero_matches)
+    return [(hero_id, counts[hero_id]) for hero_id in hero_ids]
+
+
+MATCHERS = {
+    'bf': match_bf,
+    'flann': match_flann,
+    'cascade': match_cascade,
+    'early_exit': match_early_exit,
+}
+
+# Number of recently detected heroes remembered by the descriptor index for the early exit matcher
+RECENT_HEROES = 20
+
+# Masks and output buffers of ROI extraction for each ROI polygon and image layout, reused across detections
+_roi_buffers = {}
+_ROI_BUFFERS_MAX = 64
+
+
+def extract_roi(img, roi):
+    """Crops a hero portrait from an image, blacking out pixels outside of its polygon. Only the ROI's bounding rectangle is processed,
+    the polygon mask and the output buffer are created once per ROI and image layout and reused by later calls.
+    
+    Args:
+        img (array): An array representing the image (obtained through make_screenshot function)
+        roi (array(int)): ROI polygon of the hero's portrait
+    
+    Returns:
+        array: The cropped portrait, the buffer is overwritten by the next extraction of the same ROI so copy it to keep it
+    """
+    x, y, w, h = rois_bounding_rect([roi])
+    view = img[y: y + h, x: x + w]
+
+    key = (roi.tobytes(), view.shape, view.dtype.str)
+    buffers = _roi_buffers.get(key)
+    if buffers is None:
+        # ROIs found by contours change from frame to frame, don't let stale layouts pile up
+        if len(_roi_buffers) >= _ROI_BUFFERS_MAX:
+            _roi_buffers.clear()
+        mask = np.zeros(view.shape[:2], np.uint8)
+        cv2.fillPoly(mask, pts=[(roi - np.array([x, y], dtype=roi.dtype)).astype(np.int32)], color=255)
+        if view.ndim == 3:
+            mask = np.repeat(mask[:, :, np.newaxis], view.shape[2], axis=2)
+        buffers = (mask, np.empty_like(view))
+        _roi_buffers[key] = buffers
+
+    mask, cropped = buffers
+    cv2.bitwise_and(view, mask, dst=cropped)
+    return cropped
+
+
+def match_roi(img, roi, hero_index, matcher, matcher_options=None, timings=None):
+    """Finds the best matching hero for a single hero portrait ROI.
+    
+    Args:
+        img (array): An array representing the image (obtained through make_screenshot function)
+        roi (array(int)): ROI polygon of the hero's portrait
+        hero_index (dict): Descriptor index of hero portraits (obtained through load_hero_index function)
+        matcher (str): The matching method, has to be one of MATCHERS keys
+        matcher_options (dict, optional): Keyword arguments passed to the matcher
+        timings (dict{str: list[float]}, optional): If given, durations (in seconds) of the "extract", "describe" and "match" stages are appended to it
+    
+    Returns:
+        tuple(int, int, int): ID of the best matching hero, its number of matches and the number of heroes matched
+    """
+    # Feature extractors are cheap to create, a fresh one keeps concurrent calls independent
+    extractor = create_extractor(hero_index['features'])
+
+    start = time.perf_counter()
+    cropped = extract_roi(img, roi)
+    extracted = time.perf_counter()
+    kp, des = extractor.detectAndCompute(cropped, None)
+    described = time.perf_counter()
+
+    hero_matches = MATCHERS[matcher](des, hero_index, cropped, **(matcher_options or {}))
+    best = ranking.top_k(hero_matches, 1, key=lambda x: x[1])[0]
+
+    if timings is not None:
+        timings.setdefault('extract', []).append(extracted - start)
+        timings.setdefault('describe', []).append(described - extracted)
+        timings.setdefault('match', []).append(time.perf_counter() - described)
+    return best[0], best[1], len(hero_matches)
+
+
+def match_heroes(img, rois, hero_index, matcher='bf', workers=1, matcher_options=None, timings=None):
+    """Finds the best matching hero for each hero portrait. The image comparison is done on local features of the index, either with OpenCV's
+    Brute-Force matcher for each hero, a single FLANN index of all heroes, or a cascade that matches only the heroes with the most similar colours.
+    The portraits are independent of each other, so they can be matched concurrently on a thread pool (OpenCV releases the GIL).
+    
+    Args:
+        img (array): An array representing the image (obtained through make_screenshot function)
+        rois (list[array(int)]): List of ROI polygons for coordinates of heroes' portraits
+        hero_index (dict): Descriptor index of hero portraits (obtained through load_hero_index function)
+        matcher (str, optional): The matching method, has to be one of MATCHERS keys ("bf", "flann", "cascade" or "early_exit")
+        workers (int, optional): Number of threads matching the ROIs, 1 matches them sequentially
+        matcher_options (dict, optional): Keyword arguments passed to the matcher (e.g. top_k and min_matches for "cascade")
+        timings (dict{str: list[float]}, optional): If given, durations of each portrait's stages are appended to it (see match_roi function)
+    
+    Returns:
+        list[tuple(int, int, int)]: ID of the best matching hero, its number of matches and the number of heroes matched for each ROI
+    """
+    # Build shared matcher state up front instead of racing to build it in the workers
+    if matcher == 'flann' and 'flann' not in hero_index:
+        build_flann_index(hero_index)
+
+    def match(roi):
+        return match_roi(img, roi, hero_index, matcher, matcher_options, timings)
+
+    # Compare each roi to loaded images based on local features
+    if workers > 1 and len(rois) > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(rois))) as executor:
+            best_matches = list(executor.map(match, rois))
+    else:
+        best_matches = [match(roi) for roi in rois]
+
+    # Heroes found in this frame are the most likely ones in the next frames
+    found = [hero_id for hero_id, matches_count, matched_count in best_matches if matches_count > MATCH_THRESHOLD]
+    hero_index['recent'] = list(dict.fromkeys(found + hero_index.get('recent', [])))[:RECENT_HEROES]
+    return best_matches
+
+
+def detect_heroes(heroes, img, rois, hero_index, matcher='bf', workers=1, matcher_options=None, timings=None, verbose=True):
+    """Returns a list of heroes from an image given hero portrait positions. Each portrait is compared to the precomputed descriptors of hero images
+    (see match_heroes function), heroes with too few matches are considered not found.
+    
+    Args:
+        heroes (json): JSON object containing constant data of each hero (obtained through queries.make_hero_info_query function)
+        img (array): An array representing the image (obtained through make_screenshot function)
+        rois (list[array(int)]): List of ROI polygons for coordinates of heroes' portraits
+        hero_index (dict): Descriptor index of hero portraits (obtained through load_hero_index function)
+        matcher (str, optional): The matching method, has to be one of MATCHERS keys ("bf", "flann", "cascade" or "early_exit")
+        workers (int, optional): Number of threads matching the ROIs, 1 matches them sequentially
+        matcher_options (dict, optional): Keyword arguments passed to the matcher (e.g. top_k and min_matches for "cascade")
+        timings (dict{str: list[float]}, optional): If given, durations of each portrait's stages are appended to it (see match_roi function)
+        verbose (bool, optional): Print the best match of each portrait
+    
+    Returns:
+        list[int]: List of detected heroes' IDs
+    """
+    hero_names = {}
+    for hero in heroes['constants']['heroes']:
+        hero_names[hero['id']] = hero['shortName']
+
+    best_matches = match_heroes(img, rois, hero_index, matcher, workers, matcher_options, timings)
+
+    # Results are reported in ROI order regardless of which worker finished first
+    matched_heroes = []
+    for hero_id, matches_count, matched_count in best_matches:
+        matched = hero_id if matches_count > MATCH_THRESHOLD else None
         matched_display = hero_names[matched] if matched is not None else 'Not found'
-        print(f'Best match: {matched_display} ({hero_matches[0][1]})')
+        if verbose:
+            print(f'Best match: {matched_display} ({matches_count})')
         matched_heroes.append(matched)
 
+    if matcher in ('cascade', 'early_exit') and verbose:
+        all_count = len(hero_index['descriptors'])
+        fallbacks = sum(1 for best in best_matches if best[2] == all_count)
+        compared = sum(best[2] for best in best_matches)
+        print(f'{matcher.capitalize()}: {fallbacks}/{len(rois)} portraits fell back to all heroes, '
+              f'{compared}/{all_count * len(rois)} hero comparisons')
+
     return matched_heroes
 
 
-def make_screenshot(monitor_number, path):
+def roi_signature(img, roi):
+    """Computes a cheap signature of a hero portrait that is used to tell whether the portrait changed between frames.
+    
+    Args:
+        img (array): An array representing the image (obtained through make_screenshot function)
+        roi (array(int)): ROI polygon of the hero's portrait
+    
+    Returns:
+        array: Downscaled thumbnail of the portrait's bounding rectangle
+    """
+    rect = cv2.boundingRect(roi)
+    cropped = img[rect[1]: rect[1] + rect[3], rect[0]: rect[0] + rect[2]]
+    thumb = cv2.resize(cropped, (8, 8), interpolation=cv2.INTER_AREA)
+    return thumb.astype(np.int16)
+
+
+def roi_changed(sig_prev, sig, threshold):
+    """Compares two portrait signatures.
+    
+    Args:
+        sig_prev (array): Previous signature (obtained through roi_signature function) or None if there is none
+        sig (array): Current signature (obtained through roi_signature function)
+        threshold (float): Maximal mean absolute pixel difference for the signatures to be considered the same
+    
+    Returns:
+        bool: True if the portrait changed
+    """
+    if sig_prev is None or sig_prev.shape != sig.shape:
+        return True
+    return np.abs(sig - sig_prev).mean() > threshold
+
+
+def rois_bounding_rect(rois):
+    """Computes the bounding rectangle of all given ROIs.
+    
+    Args:
+        rois (list[array(int)]): List of ROI polygons
+    
+    Returns:
+        tuple(int, int, int, int): X and Y coordinates, width and height of the rectangle
+    """
+    points = np.concatenate([roi.reshape(-1, 2) for roi in rois])
+    x, y = points.min(axis=0)
+    x_max, y_max = points.max(axis=0)
+    return int(x), int(y), int(x_max - x + 1), int(y_max - y + 1)
+
+
+def translate_rois(rois, x, y):
+    """Moves ROIs into the coordinates of an image region starting at the given point.
+    
+    Args:
+        rois (list[array(int)]): List of ROI polygons
+        x (int): X coordinate of the region's origin
+        y (int): Y coordinate of the region's origin
+    
+    Returns:
+        list[array(int)]: List of translated ROI polygons
+    """
+    return [roi - np.array([x, y], dtype=roi.dtype) for roi in rois]
+
+
+def make_screenshot(monitor_number, path, region=None):
     """Creates an image either from making a snapshot of the monitor or loading from file.
     
     Args:
         monitor_number (int): Number of the monitor to get screenshot of (only used when path is "live")
         path (str): Either "live" to capture the screen or a path to the image to load from file
+        region (tuple(int, int, int, int), optional): X and Y coordinates, width and height of the part of the monitor (or image)
+            to capture, by default the whole monitor (or image) is captured
     
     Returns:
         array: An array representing the image
     """
     if path != 'live':
         img = cv2.imread(path)
+        if region is not None:
+            x, y, w, h = region
+            img = img[y: y + h, x: x + w]
         return img
 
     with mss() as sct:
         mon = sct.monitors[monitor_number]
+        if region is not None:
+            x, y, w, h = region
+            mon = {'left': mon['left'] + x, 'top': mon['top'] + y, 'width': w, 'height': h}
         img = np.array(sct.grab(mon))
         return img
 
 
-def test_detection(monitor_number, screenshot_path, roi_method):
+def test_detection(img, rois):
     """Creates an OpenCV window containing the image. Used for debugging.
     
     Args:
-        monitor_number (int): Number of the monitor to get screenshot of (only used when screenshot_path is "live")
-        screenshot_path (str): Either "live" to capture the screen or a path to the image to load from file
-        roi_method (str): The method to detect ROIs, has to be either "predefined" or "contour"
+        img (array): An array representing the image (obtained through make_screenshot function)
+        rois (list[array(int)]): List of ROI polygons for coordinates of heroes' portraits
     """
-    # Get screenshot
-    img = make_screenshot(monitor_number, screenshot_path)
-    rois = predefined_rois() if roi_method == 'predefined' else get_hero_rois(img)
-
     img_rois = img.copy()
      
     # Draw ROIs
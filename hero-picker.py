@@ -1,14 +1,25 @@
 import asyncio
+import concurrent.futures
+import contextlib
 import json
 import aiohttp
+import queue
 import sys
+import threading
+import time
 
 import queries
+import query_cache
 import ui
 import assets
 import stats
 import detection
+import layout
+import matchup_parser
+import search
+import stratz_stub
 from misc import Error
+from request_policy import RequestPolicy
 from pathlib import Path
 
 
@@ -62,50 +73,103 @@ def get_hero_ids_from_names(config, heroes, hero_count):
     return include_ids
 
 
-def get_heroes(monitor_number, screenshot_path, roi_method, heroes):
-    """Gets heroes from either a file image or screenshot.
+def grab_screen(config):
+    """Captures the screen (or loads the test image) and locates hero portraits on it.
+    Unless ROIs are found by contours, only the strip containing the portraits is captured and the ROIs are translated to match it.
     
     Args:
-        monitor_number (int): Number of the monitor to get screenshot of (only used when screenshot_path is "live")
-        screenshot_path (str): Either "live" to capture the screen or a path to the image to load from file
-        roi_method (str): The method to detect ROIs, has to be either "predefined" or "contour"
-        heroes (json): Hero information obtained through queries.make_hero_info_query
+        config (json): Loaded user specific config file
     
     Returns:
-        tuple(list[int], list[int]): List of hero IDs for radiant and dire team
+        tuple(array, list[array(int)]): The image and ROI polygons of hero portraits
     """
+    monitor_number = config['image']['monitor_number']
+    screenshot_path = config['image']['screenshot']
+    roi_method = config['image']['roi_method']
+
     if screenshot_path != 'live':
         screenshot_path = str(Path(Path(__file__).parent, screenshot_path))
-    images_path = Path(__file__).resolve().with_name('images')
 
-    img = detection.make_screenshot(monitor_number, screenshot_path)
-    rois = detection.predefined_rois() if roi_method == 'predefined' else detection.get_hero_rois(img)
+    if roi_method == 'contour':
+        img = detection.make_screenshot(monitor_number, screenshot_path)
+        rois = detection.get_hero_rois(img)
+    else:
+        rois = layout.get_rois(monitor_number, screenshot_path, roi_method, Path(__file__).resolve().with_name('layouts.json'))
+        region = detection.rois_bounding_rect(rois)
+        img = detection.make_screenshot(monitor_number, screenshot_path, region)
+        rois = detection.translate_rois(rois, region[0], region[1])
+    return img, rois
 
-    detected_heroes = detection.detect_heroes(heroes, img, rois, images_path)
+
+def detector_options(config, meta_heroes=None):
+    """Collects the hero detection settings from the config.
+    
+    Args:
+        config (json): Loaded user specific config file
+        meta_heroes (list[list[tuple(int, float)]], optional): List of best heroes for each position, the early exit matcher tries them first
+    
+    Returns:
+        dict: Keyword arguments for detection.detect_heroes
+    """
+    matcher = config['image']['matcher']
+    # Options of a matcher are stored in an object named after it
+    matcher_options = config['image'].get(matcher)
+    if matcher == 'early_exit' and meta_heroes:
+        hints = [hero_id for heroes in meta_heroes for hero_id, win_rate in heroes]
+        matcher_options = {**(matcher_options or {}), 'hints': hints}
+    return {
+        'matcher': matcher,
+        'workers': config['image']['workers'],
+        'matcher_options': matcher_options,
+    }
+
+
+def split_teams(detected_heroes):
+    """Splits detected heroes (ordered as hero portraits on the screen) into teams.
+    
+    Args:
+        detected_heroes (list[int]): List of detected heroes' IDs, None for portraits where no hero was found
+    
+    Returns:
+        tuple(list[int], list[int]): List of hero IDs for radiant and dire team
+    """
     dire_heroes = [hero for hero in detected_heroes[:5] if hero]
     radiant_heroes = [hero for hero in detected_heroes[5:] if hero]
     return radiant_heroes, dire_heroes
 
 
-def get_picks(config, is_radiant, heroes, meta_heroes, hero_names, hero_matchups, player_wrs, pos=None):
-    """Displays the best heroes for the given team.
+def get_heroes(config, heroes, hero_index, meta_heroes=None):
+    """Gets heroes from either a file image or screenshot.
     
     Args:
         config (json): Loaded user specific config file
-        is_radiant (bool): Determines if picking for radiant side
         heroes (json): Hero information obtained through queries.make_hero_info_query
+        hero_index (dict): Descriptor index of hero portraits (obtained through detection.load_hero_index)
+        meta_heroes (list[list[tuple(int, float)]], optional): List of best heroes (their ID and win rate) for each position
+    
+    Returns:
+        tuple(list[int], list[int]): List of hero IDs for radiant and dire team
+    """
+    img, rois = grab_screen(config)
+
+    detected_heroes = detection.detect_heroes(heroes, img, rois, hero_index, **detector_options(config, meta_heroes))
+    return split_teams(detected_heroes)
+
+
+def show_picks(is_radiant, radiant_heroes, dire_heroes, meta_heroes, hero_names, hero_matchups, player_wrs, pos=None, draft=None):
+    """Displays the detected heroes and the best heroes for the given team.
+    
+    Args:
+        is_radiant (bool): Determines if picking for radiant side
+        radiant_heroes (list[int]): List of hero indexes for radiant
+        dire_heroes (list[int]): List of hero indexes for dire
         meta_heroes (list[list[tuple(int, float)]]): List of best heroes (their ID and win rate) for each position
         hero_names (dict{int: str}): Dictionary of hero names for hero indexes
-        hero_matchups (dict{int: json}): Match up data for each hero ID (obtained through queries.make_heroes_matchup_query)
+        hero_matchups (dict): Counter and synergy matrices of all heroes (obtained through get_hero_matchups function)
         player_wrs (json): Object containing player's win rates for each hero (obtained through queries.get_player_winrates function)
         pos (list[int], optional): List of positions to consider, by default includes all positions (1-5)
+        draft (stats.DraftState, optional): Draft kept across calls, only the changed picks are applied to it
     """
-    monitor_number = config['image']['monitor_number']
-    screenshot_path = config['image']['screenshot']
-    roi_method = config['image']['roi_method']
-
-    radiant_heroes, dire_heroes = get_heroes(monitor_number, screenshot_path, roi_method, heroes)
-
     print('Detected radiant: ', [hero_names[hero] for hero in radiant_heroes])
     print('Detected dire: ', [hero_names[hero] for hero in dire_heroes])
 
@@ -115,72 +179,201 @@ def get_picks(config, is_radiant, heroes, meta_heroes, hero_names, hero_matchups
     print("WITH: " + ', '.join([hero_names[hero] for hero in with_idx]))
     print("AGAINST: " + ', '.join([hero_names[hero] for hero in against_idx]))
 
-    best_picks = stats.get_best_pick_by_pos(meta_heroes, hero_matchups, radiant_heroes, dire_heroes, is_radiant, pos)
+    if draft is None:
+        best_picks = stats.cached_best_pick_by_pos(meta_heroes, hero_matchups, radiant_heroes, dire_heroes, is_radiant, pos)
+    else:
+        draft.set_teams(radiant_heroes, dire_heroes)
+        best_picks = draft.suggestions(pos)
     ui.print_best_picks(hero_names, best_picks, player_wrs)
 
 
-async def get_hero_matchups(bracket, all_hero_count, stratz_token):
+def get_picks(config, is_radiant, heroes, hero_index, meta_heroes, hero_names, hero_matchups, player_wrs, pos=None):
+    """Displays the best heroes for the given team.
+    
+    Args:
+        config (json): Loaded user specific config file
+        is_radiant (bool): Determines if picking for radiant side
+        heroes (json): Hero information obtained through queries.make_hero_info_query
+        hero_index (dict): Descriptor index of hero portraits (obtained through detection.load_hero_index)
+        meta_heroes (list[list[tuple(int, float)]]): List of best heroes (their ID and win rate) for each position
+        hero_names (dict{int: str}): Dictionary of hero names for hero indexes
+        hero_matchups (dict): Counter and synergy matrices of all heroes (obtained through get_hero_matchups function)
+        player_wrs (json): Object containing player's win rates for each hero (obtained through queries.get_player_winrates function)
+        pos (list[int], optional): List of positions to consider, by default includes all positions (1-5)
+    """
+    radiant_heroes, dire_heroes = get_heroes(config, heroes, hero_index, meta_heroes)
+    show_picks(is_radiant, radiant_heroes, dire_heroes, meta_heroes, hero_names, hero_matchups, player_wrs, pos)
+
+
+def search_picks(config, is_radiant, heroes, hero_index, meta_heroes, hero_names, hero_matchups, player_wrs, pos=None):
+    """Displays the best lineup (one hero for each remaining position) for the given team.
+    
+    Args:
+        config (json): Loaded user specific config file
+        is_radiant (bool): Determines if picking for radiant side
+        heroes (json): Hero information obtained through queries.make_hero_info_query
+        hero_index (dict): Descriptor index of hero portraits (obtained through detection.load_hero_index)
+        meta_heroes (list[list[tuple(int, float)]]): List of best heroes (their ID and win rate) for each position
+        hero_names (dict{int: str}): Dictionary of hero names for hero indexes
+        hero_matchups (dict): Counter and synergy matrices of all heroes (obtained through get_hero_matchups function)
+        player_wrs (json): Object containing player's win rates for each hero (obtained through queries.get_player_winrates function)
+        pos (list[int], optional): Positions that are still to be picked, by default includes all positions (1-5)
+    """
+    radiant_heroes, dire_heroes = get_heroes(config, heroes, hero_index, meta_heroes)
+    print('Detected radiant: ', [hero_names[hero] for hero in radiant_heroes])
+    print('Detected dire: ', [hero_names[hero] for hero in dire_heroes])
+
+    if pos is None:
+        pos = [1, 2, 3, 4, 5]
+    allies = radiant_heroes if is_radiant else dire_heroes
+    if len(pos) > 5 - len(allies):
+        print(f'{len(allies)} heroes are picked already, give the remaining positions (e.g. s{"r" if is_radiant else "d"}45)')
+        return
+
+    cfg_search = config['stats']['search']
+    problem = search.make_problem(meta_heroes, hero_matchups, radiant_heroes, dire_heroes, is_radiant, pos, cfg_search['responses'])
+    result = search.search_lineup(problem, cfg_search['time_budget'], cfg_search['workers'])
+    if result is None:
+        print('Not enough meta heroes left for the positions')
+        return
+
+    best_by_pos = [[], [], [], [], []]
+    for p, hero in zip(pos, result['lineup']):
+        best_by_pos[p - 1].append(hero)
+    ui.print_best_picks(hero_names, best_by_pos, player_wrs)
+    if result['responses']:
+        print('Expected enemy picks: ' + ', '.join([hero_names[hero] for hero in result['responses']]))
+    status = 'complete' if result['complete'] else 'stopped after the time budget, best lineup so far'
+    print(f'Lineup value: {round(result["value"], 2)} ({status}, {result["nodes"]} nodes)')
+
+
+def watch_picks(config, is_radiant, heroes, hero_index, meta_heroes, hero_names, hero_matchups, player_wrs, stop):
+    """Polls the screen and refreshes the best heroes for the given team whenever the detected heroes change.
+    Only portraits that changed since they were last matched are matched again, and only once they stop changing
+    (so heroes are matched after they are locked in instead of during animations).
+    
+    Args:
+        config (json): Loaded user specific config file
+        is_radiant (bool): Determines if picking for radiant side
+        heroes (json): Hero information obtained through queries.make_hero_info_query
+        hero_index (dict): Descriptor index of hero portraits (obtained through detection.load_hero_index)
+        meta_heroes (list[list[tuple(int, float)]]): List of best heroes (their ID and win rate) for each position
+        hero_names (dict{int: str}): Dictionary of hero names for hero indexes
+        hero_matchups (dict): Counter and synergy matrices of all heroes (obtained through get_hero_matchups function)
+        player_wrs (json): Object containing player's win rates for each hero (obtained through queries.get_player_winrates function)
+        stop (threading.Event): Event that stops watching when set
+    """
+    options = detector_options(config, meta_heroes)
+    interval = 1 / config['image']['watch_rate']
+    threshold = config['image']['watch_threshold']
+    draft = stats.DraftState(meta_heroes, hero_matchups, is_radiant)
+
+    detected_heroes = []
+    prev_sigs = []
+    matched_sigs = []
+    shown = ([], [])
+
+    while not stop.is_set():
+        img, rois = grab_screen(config)
+        sigs = [detection.roi_signature(img, roi) for roi in rois]
+
+        # The number of portraits can only change with contour based ROIs, start over in that case
+        if len(sigs) != len(detected_heroes):
+            detected_heroes = [None] * len(sigs)
+            prev_sigs = [None] * len(sigs)
+            matched_sigs = [None] * len(sigs)
+
+        changed = []
+        for i, sig in enumerate(sigs):
+            settled = not detection.roi_changed(prev_sigs[i], sig, threshold)
+            if settled and detection.roi_changed(matched_sigs[i], sig, threshold):
+                changed.append(i)
+        prev_sigs = sigs
+
+        if changed:
+            matched = detection.detect_heroes(heroes, img, [rois[i] for i in changed], hero_index, **options)
+            for i, hero in zip(changed, matched):
+                detected_heroes[i] = hero
+                matched_sigs[i] = sigs[i]
+
+            radiant_heroes, dire_heroes = split_teams(detected_heroes)
+            if (radiant_heroes, dire_heroes) != shown:
+                shown = (radiant_heroes, dire_heroes)
+                show_picks(is_radiant, radiant_heroes, dire_heroes, meta_heroes, hero_names, hero_matchups, player_wrs, draft=draft)
+
+        stop.wait(interval)
+
+
+async def get_hero_matchups(bracket, all_hero_count, cache, on_refresh=None, stream=False):
     """Gets the counters and synergy values for each hero
     
     Args:
         bracket (str): Selected bracket from the config
         all_hero_count (int): The number of all heroes
-        stratz_token (TYPE): Player's Stratz API token
+        cache (query_cache.QueryCache): Cache of Stratz query results
+        on_refresh (function, optional): A function(dict) called with the matrices of fresh data if outdated cached data was returned
+        stream (bool, optional): If True, the response is parsed as it arrives straight into arrays, without building the JSON tree
     
     Returns:
-        dict{int: json}: Match up data for each hero ID
+        dict: Counter and synergy matrices of all heroes (obtained through stats.build_matchup_matrices)
     """
     bracket_combined = bracket
     if bracket == 'IMMORTAL' or bracket == 'DIVINE':
         bracket_combined = 'DIVINE_IMMORTAL'
-    hero_matchups = {}
 
-    matchups = await queries.run_query(queries.make_heroes_matchup_query(bracket_combined, all_hero_count), stratz_token)
-    for hero in matchups['heroStats']['matchUp']:
-        hero_id = hero['heroId']
-        hero_matchups[hero_id] = hero
+    def parse(matchups):
+        # Only the dense matrices are kept, the JSON response is dropped
+        vs_pairs, with_pairs = stats.matchup_arrays(matchups['heroStats']['matchUp'])
+        return stats.build_matchup_matrices(vs_pairs, with_pairs)
 
-    return hero_matchups
+    query = queries.make_heroes_matchup_query(bracket_combined, all_hero_count)
+    if stream:
+        refresh = (lambda pairs: on_refresh(stats.build_matchup_matrices(*pairs))) if on_refresh else None
+        return stats.build_matchup_matrices(*await cache.run_stream(query, 'matchups', matchup_parser.MatchupParser, refresh))
 
+    refresh = (lambda matchups: on_refresh(parse(matchups))) if on_refresh else None
+    return parse(await cache.run(query, 'matchups', refresh))
 
-def show_grid(config, heroes, hero_names, hero_matchups):
+
+def show_grid(config, heroes, hero_index, hero_names, hero_matchups):
     """Displays the tables of every hero counters and synergies for both teams.
     
     Args:
         config (json): Loaded user specific config file
         heroes (json): Hero information obtained through queries.make_hero_info_query
+        hero_index (dict): Descriptor index of hero portraits (obtained through detection.load_hero_index)
         hero_names (dict{int: str}): Dictionary of hero names for hero indexes
-        hero_matchups (dict{int: json}): Match up data for each hero ID (obtained through queries.make_heroes_matchup_query)
+        hero_matchups (dict): Counter and synergy matrices of all heroes (obtained through get_hero_matchups function)
     """
-    stratz_token = config['stratz']['token']
-    monitor_number = config['image']['monitor_number']
-    screenshot_path = config['image']['screenshot']
-    roi_method = config['image']['roi_method']
-    bracket = config['stats']['bracket']
-
-    radiant_heroes, dire_heroes = get_heroes(monitor_number, screenshot_path, roi_method, heroes)
+    radiant_heroes, dire_heroes = get_heroes(config, heroes, hero_index)
 
-    grid_vs, grid_rad, grid_dire = stats.calc_adv_matrix(radiant_heroes, dire_heroes, hero_matchups)
+    grid_vs, grid_rad, grid_dire = stats.cached_adv_matrix(radiant_heroes, dire_heroes, hero_matchups)
     ui.print_grids(radiant_heroes, dire_heroes, hero_names, grid_vs, grid_rad, grid_dire)
 
 
-def cli(config, heroes, pos_heroes, hero_names, hero_matchups, player_wrs):
+def cli(config, heroes, hero_index, pos_heroes, hero_names, hero_matchups, player_wrs, refreshes=None):
     """Runs the command-line interface loop that awaits user's input and executes the given command.
     
     Args:
         config (json): Loaded user specific config file
         heroes (json): Hero information obtained through queries.make_hero_info_query
+        hero_index (dict): Descriptor index of hero portraits (obtained through detection.load_hero_index)
         pos_heroes (list[list[tuple(int, float)]]): List of best heroes (their ID and win rate) for each position
         hero_names (dict{int: str}): Dictionary of hero names for hero indexes
-        hero_matchups (dict{int: json}): Match up data for each hero ID (obtained through queries.make_heroes_matchup_query)
+        hero_matchups (dict): Counter and synergy matrices of all heroes (obtained through get_hero_matchups function)
         player_wrs (json): Object containing player's win rates for each hero (obtained through queries.get_player_winrates function)
+        refreshes (queue.SimpleQueue, optional): Fresh data downloaded in the background, as tuples of the argument name
+            ("pos_heroes", "hero_matchups" or "player_wrs") and its new value, applied before each command
     """
     print('Type a command.')
     cmds = ['r (radiant)[pos]: analyze picks for radiant (optinally for given position, e.g. r2)',
         'd (dire)[pos]: analyze picks for dire (optinally for given position, e.g. d2)',
+        's (search)side[pos]: find the best lineup for the remaining positions (e.g. sr or sd345)',
         't (test): test hero detection',
         'h (heroes): display hero details',
         'g (grid): detailed hero matchups',
+        'c (cache): suggestion cache statistics',
+        'w (watch)side: keep watching the draft and refresh picks for the given side (wr or wd)',
         'q (quit): exit']
     for cmd in cmds:
         print(f'\t{cmd}')
@@ -189,6 +382,15 @@ def cli(config, heroes, pos_heroes, hero_names, hero_matchups, player_wrs):
     while command != 'q':
         print('prompt> ', end='')
         command = input()
+        while refreshes is not None and not refreshes.empty():
+            name, value = refreshes.get()
+            if name == 'pos_heroes':
+                pos_heroes = value
+            elif name == 'hero_matchups':
+                hero_matchups = value
+            elif name == 'player_wrs':
+                player_wrs = value
+            print(f'Using fresh {name.replace("_", " ")} data')
         picking = command.startswith('r') or command.startswith('d')
         if picking and (len(command) == 1 or len(command) == 2):
             pos = None
@@ -199,39 +401,107 @@ def cli(config, heroes, pos_heroes, hero_names, hero_matchups, player_wrs):
             is_radiant = command[0] == 'r'
             side = 'radiant' if is_radiant else 'dire'
             print(f'Picking for {side}')
-            get_picks(config, is_radiant, heroes, pos_heroes, hero_names, hero_matchups, player_wrs, pos)
+            get_picks(config, is_radiant, heroes, hero_index, pos_heroes, hero_names, hero_matchups, player_wrs, pos)
+        elif command[:2] in ('sr', 'sd'):
+            if set(command[2:]) - set('12345'):
+                continue
+            pos = sorted(set(int(p) for p in command[2:])) or None
+            is_radiant = command[1] == 'r'
+            side = 'radiant' if is_radiant else 'dire'
+            print(f'Searching lineup for {side}')
+            search_picks(config, is_radiant, heroes, hero_index, pos_heroes, hero_names, hero_matchups, player_wrs, pos)
         elif command == 't':
             cfg_im = config['image']
             screenshot_path = cfg_im['screenshot']
             if screenshot_path != 'live':
                 screenshot_path = str(Path(Path(__file__).parent, screenshot_path))
-            detection.test_detection(cfg_im['monitor_number'], screenshot_path, cfg_im['roi_method'])
+            img = detection.make_screenshot(cfg_im['monitor_number'], screenshot_path)
+            if cfg_im['roi_method'] == 'contour':
+                rois = detection.get_hero_rois(img)
+            else:
+                rois = layout.get_rois(cfg_im['monitor_number'], screenshot_path, cfg_im['roi_method'],
+                                       Path(__file__).resolve().with_name('layouts.json'))
+            detection.test_detection(img, rois)
         elif command == 'h':
             ui.print_hero_data(heroes)
         elif command == 'g':
-            show_grid(config, heroes, hero_names, hero_matchups)
-
-
-async def get_player_winrates(player_id, all_hero_count, stratz_token):
+            show_grid(config, heroes, hero_index, hero_names, hero_matchups)
+        elif command == 'c':
+            info = stats.suggestion_cache.info()
+            print(f'Suggestion cache: {info["hits"]} hits, {info["misses"]} misses, {info["size"]}/{info["maxsize"]} entries')
+        elif command == 'wr' or command == 'wd':
+            is_radiant = command[1] == 'r'
+            side = 'radiant' if is_radiant else 'dire'
+            print(f'Watching picks for {side}, press Enter to stop')
+            stop = threading.Event()
+            watcher = threading.Thread(target=watch_picks, args=(config, is_radiant, heroes, hero_index, pos_heroes,
+                                                                 hero_names, hero_matchups, player_wrs, stop))
+            watcher.start()
+            try:
+                input()
+            finally:
+                stop.set()
+                watcher.join()
+
+
+async def get_player_winrates(player_id, all_hero_count, cache, on_refresh=None):
     """Gets player's win rate for each hero.
     
     Args:
         player_id (long): Player's Steam ID from config
         all_hero_count (int): The number of all heroes
-        stratz_token (str): Player's Stratz token
+        cache (query_cache.QueryCache): Cache of Stratz query results
+        on_refresh (function, optional): A function(dict) called with fresh win rates if outdated cached data was returned
     
     Returns:
         dict{int: json}: A JSON object describing winrate for each hero ID
     """
-    wrs = {}
-    if player_id != None:
-        data = await queries.run_query(queries.make_player_winrates_query(player_id, all_hero_count), stratz_token)
+    def parse(data):
+        wrs = {}
         for hero in data['player']['heroesPerformance']:
             wrs[hero['heroId']] = hero
-    return wrs
+        return wrs
+
+    if player_id == None:
+        return {}
+    refresh = (lambda data: on_refresh(parse(data))) if on_refresh else None
+    query = queries.make_player_winrates_query(player_id, all_hero_count)
+    return parse(await cache.run(query, 'player', refresh))
+
+
+@contextlib.asynccontextmanager
+async def stratz_apis(config, recording):
+    """Gets the GraphQL API URLs queried for the selected Stratz mode. In "replay" mode a local server answering with the recorded
+    results is started and stopped on exit.
+    
+    Args:
+        config (dict): Stratz configuration
+        recording (stratz_stub.Recording): Recorded query results, only used in "replay" mode
+    
+    Yields:
+        list[str]: URLs of the primary and the fallback GraphQL API, empty for the Stratz ones
+    """
+    if config['mode'] != 'replay':
+        yield config['apis']
+        return
+    try:
+        recording.load()
+    except OSError:
+        raise Error(f'Recording {recording.path} not found, run in record mode first')
+    runner, url = await stratz_stub.start_server(recording, **config['replay'])
+    try:
+        yield [url]
+    finally:
+        await runner.cleanup()
 
 
-async def main():
+async def main(loaded, done):
+    """Loads the data and keeps refreshing it in the background while the CLI runs.
+    
+    Args:
+        loaded (concurrent.futures.Future): Set to the arguments of cli function once the data is loaded
+        done (threading.Event): Set when the CLI exits, after which the connections are closed
+    """
     # Load config and hero assets
     path_config = Path(__file__).resolve().with_name('config.json')
     with open(path_config, 'r', encoding='utf-8') as fp:
@@ -241,50 +511,161 @@ async def main():
     screenshot_path = config['image']['screenshot']
     hero_count = config['stats']['meta_heroes_count']
     pick_thr = config['stats']['pickrate_threshold']
+    stats.suggestion_cache.resize(config['stats']['cache_size'])
     bracket = config['stats']['bracket']
 
     path_images = Path(__file__).resolve().with_name('images')
+    features = config['image']['features']
+    path_index = Path(__file__).resolve().with_name(f'hero_index_{features}.npz')
     assets.get_hero_assets(path_images)
     ui.init()
 
-    # Get meta heroes for each role
-    heroes = await queries.run_query(queries.make_hero_info_query(), stratz_token)
-    hero_names = get_hero_names(heroes)
-    all_hero_count = len(hero_names)
-
-    pos_win_rates = []
-    for pos in range(0, 5):
-        win_rates = await queries.run_query(queries.make_hero_winrate_query(pos + 1, bracket), stratz_token)
-        pos_win_rates.append(win_rates)
-
-    pos_heroes = stats.get_best_heroes_by_pos(pos_win_rates, pick_thr, hero_count)
-    print('Meta picks')
-    ui.print_meta_heroes(pos_heroes, hero_names, hero_count)
-
-    # Replace worst meta picks with custom picks
-    include_ids = get_hero_ids_from_names(config, heroes, hero_count)
-    pos_heroes = stats.include_heroes(pos_heroes, include_ids, hero_count, pos_win_rates)
-    print()
-    print('Meta + custom picks')
-    ui.print_meta_heroes(pos_heroes, hero_names, hero_count)
-
-    matchups = await get_hero_matchups(bracket, all_hero_count, stratz_token)
+    started = time.perf_counter()
+
+    def progress(stage):
+        print(f'[{time.perf_counter() - started:.1f} s] Loaded {stage}')
+
+    # Connections to Stratz are shared by every query and closed on exit
+    # Query results can be recorded, and replayed later by a local server instead of querying Stratz
+    policy = RequestPolicy(**config['stratz']['policy'])
+    recording = stratz_stub.Recording(Path(__file__).resolve().with_name(config['stratz']['recording']))
+    recorder = recording if config['stratz']['mode'] == 'record' else None
+    async with stratz_apis(config['stratz'], recording) as apis, \
+            queries.StratzClient(stratz_token, config['stratz']['connection_limit'], config['stratz']['max_concurrent_queries'],
+                                 policy=policy, apis=apis, recorder=recorder) as client:
+        # Stratz results are cached on disk, outdated results are used right away and refreshed in the background
+        cache = query_cache.QueryCache(client, Path(__file__).resolve().with_name('stratz_cache'), config['stratz']['cache_meta'],
+                                       config['stratz']['cache_ttl'], config['stratz']['cache_max_stale'])
+        refreshes = queue.SimpleQueue()
+
+        def meta_picks(pos_win_rates):
+            pos_heroes = stats.get_best_heroes_by_pos(pos_win_rates, pick_thr, hero_count)
+            # Replace worst meta picks with custom picks
+            return pos_heroes, stats.include_heroes(pos_heroes, include_ids, hero_count, pos_win_rates)
+
+        def refresh_win_rates(pos, win_rates):
+            pos_win_rates[pos] = win_rates
+            refreshes.put(('pos_heroes', meta_picks(pos_win_rates)[1]))
+
+        # Hero information and win rates of each position don't depend on anything, they are loaded in a single request
+        startup_queries = [queries.make_hero_info_query()] + [queries.make_hero_winrate_query(pos + 1, bracket) for pos in range(0, 5)]
+        results = await cache.run_many(startup_queries, ['heroes'] + ['winrates'] * 5,
+                                       lambda idx, data: refresh_win_rates(idx - 1, data) if idx else None)
+        heroes, pos_win_rates = results[0], results[1:]
+        hero_names = get_hero_names(heroes)
+        all_hero_count = len(hero_names)
+        progress('hero information and win rates')
+
+        # Portrait descriptors are extracted once and reused by every detection
+        async def load_hero_index():
+            hero_index = await asyncio.to_thread(detection.load_hero_index, heroes, path_images, path_index, features)
+            progress('hero portraits')
+            return hero_index
+
+        async def load_matchups():
+            # Streamed results aren't JSON, so they can't be recorded
+            stream = config['stats']['stream_matchups'] and config['stratz']['mode'] != 'record'
+            matchups = await get_hero_matchups(bracket, all_hero_count, cache,
+                                               lambda matchups: refreshes.put(('hero_matchups', matchups)), stream)
+            progress('hero match ups')
+            return matchups
+
+        # Player's hero win rates
+        async def load_player_winrates():
+            player_wrs = await get_player_winrates(config['steam']['user'], all_hero_count, cache,
+                                                   lambda player_wrs: refreshes.put(('player_wrs', player_wrs)))
+            progress('player win rates')
+            return player_wrs
+
+        hero_index_task = asyncio.create_task(load_hero_index())
+        matchups_task = asyncio.create_task(load_matchups())
+        player_task = asyncio.create_task(load_player_winrates())
+
+        include_ids = get_hero_ids_from_names(config, heroes, hero_count)
+        meta_heroes, pos_heroes = meta_picks(pos_win_rates)
+        print('Meta picks')
+        ui.print_meta_heroes(meta_heroes, hero_names, hero_count)
+        print()
+        print('Meta + custom picks')
+        ui.print_meta_heroes(pos_heroes, hero_names, hero_count)
+
+        # The CLI only needs the player's win rates for display, they are passed on once loaded
+        hero_index, matchups = await asyncio.gather(hero_index_task, matchups_task)
+
+        def player_loaded(task):
+            if task.cancelled():
+                return
+            if task.exception() is not None:
+                print(f'Could not load player win rates: {task.exception()}')
+            else:
+                refreshes.put(('player_wrs', task.result()))
+
+        player_wrs = {}
+        if player_task.done() and player_task.exception() is None:
+            player_wrs = player_task.result()
+        else:
+            player_task.add_done_callback(player_loaded)
+
+        timing = client.timing_summary()
+        if timing['requests']:
+            print(f'Stratz: {timing["requests"]} requests over {timing["connections"]} connections, '
+                  f'{timing["connect"]:.2f} s handshakes, {timing["wait"]:.2f} s waiting, {timing["transfer"]:.2f} s transfers')
+
+        # The CLI runs on the main thread (so Ctrl+C quits it), cached data is refreshed in this thread meanwhile
+        loaded.set_result((config, heroes, hero_index, pos_heroes, hero_names, matchups, player_wrs, refreshes))
+        await asyncio.to_thread(done.wait)
+        # Refreshes still running are only useful until the program exits
+        player_task.cancel()
+        await cache.close()
+
+
+def run_loop(loaded, done):
+    """Runs main function in its own event loop, errors before the data is loaded are passed to the main thread.
+    
+    Args:
+        loaded (concurrent.futures.Future): Set to the arguments of cli function once the data is loaded
+        done (threading.Event): Set when the CLI exits
+    """
+    try:
+        asyncio.run(main(loaded, done))
+    except BaseException as e:
+        if not loaded.done():
+            loaded.set_exception(e)
+        elif not isinstance(e, (Error, aiohttp.ClientError)):
+            raise
 
-    # Player's hero win rates
-    player_wrs = await get_player_winrates(config['steam']['user'], all_hero_count, stratz_token)
 
-    # Run CLI loop
-    cli(config, heroes, pos_heroes, hero_names, matchups, player_wrs)
+def wait_loaded(loaded):
+    """Waits for the data to be loaded. The wait is split into short timeouts, so Ctrl+C interrupts it on every platform.
+    
+    Args:
+        loaded (concurrent.futures.Future): Set to the arguments of cli function once the data is loaded
+    
+    Returns:
+        tuple: Arguments of cli function
+    """
+    while True:
+        try:
+            return loaded.result(timeout=0.5)
+        except concurrent.futures.TimeoutError:
+            continue
 
 
 if __name__ == '__main__':
-    coro = main()
+    loaded = concurrent.futures.Future()
+    done = threading.Event()
+    # Stratz data is loaded and refreshed by an event loop in a background thread
+    loop_thread = threading.Thread(target=run_loop, args=(loaded, done), daemon=True)
+    loop_thread.start()
     try:
-        asyncio.run(coro)
+        cli(*wait_loaded(loaded))
     except aiohttp.ClientError:
         raise Error('Something happened with the network. Maybe Stratz is unavailable or your internet is down.')
     except Error as e:
         print('Error: {}\n'.format(e.args[0]))
     finally:
+        # Background refreshes are cancelled and connections closed, unless the data is still loading
+        done.set()
+        loop_thread.join(timeout=5)
         if getattr(sys, "frozen", False):
             input()
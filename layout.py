@@ -0,0 +1,165 @@
+import json
+import os
+import numpy as np
+from mss import mss
+
+import detection
+
+
+# Resolution the predefined ROI coordinates are based on
+BASE_WIDTH = 1920
+BASE_HEIGHT = 1080
+
+# Layouts loaded from (or saved to) the cache file, keyed by cache file path and layout key
+_layouts = {}
+
+# Resolutions of monitors and images, keyed by monitor number and screenshot path (and the image's modification time)
+_resolutions = {}
+
+
+def get_resolution(monitor_number, screenshot_path):
+    """Gets the resolution of the monitor or of the image loaded instead of it. The resolution is only read once, so captures
+    don't pay for decoding the whole image or opening another screen capture session. Monitor resolutions are kept until the
+    program exits, images are read again when they are modified.
+    
+    Args:
+        monitor_number (int): Number of the monitor (only used when screenshot_path is "live")
+        screenshot_path (str): Either "live" to capture the screen or a path to the image to load from file
+    
+    Returns:
+        tuple(int, int): Width and height in pixels
+    """
+    if screenshot_path != 'live':
+        key = (monitor_number, screenshot_path, os.path.getmtime(screenshot_path))
+        if key not in _resolutions:
+            img = detection.make_screenshot(monitor_number, screenshot_path)
+            _resolutions[key] = img.shape[1], img.shape[0]
+        return _resolutions[key]
+
+    key = (monitor_number, screenshot_path)
+    if key not in _resolutions:
+        with mss() as sct:
+            mon = sct.monitors[monitor_number]
+            _resolutions[key] = mon['width'], mon['height']
+    return _resolutions[key]
+
+
+def scale_rois(rois, width, height):
+    """Maps ROIs defined for full HD resolution to another resolution. The hero bar is anchored to the top center of the screen
+    and scales with the screen height, so wider aspect ratios only move it horizontally.
+    
+    Args:
+        rois (list[array(int)]): List of ROI polygons in full HD coordinates
+        width (int): Width of the target resolution
+        height (int): Height of the target resolution
+    
+    Returns:
+        list[array(int)]: List of ROI polygons in the target resolution
+    """
+    scale = height / BASE_HEIGHT
+    scaled = []
+    for roi in rois:
+        points = roi.astype(np.float64)
+        points[..., 0] = (points[..., 0] - BASE_WIDTH / 2) * scale + width / 2
+        points[..., 1] = points[..., 1] * scale
+        scaled.append(np.round(points).astype(np.int32))
+    return scaled
+
+
+def calibrate(img):
+    """Finds hero portraits on a pick phase image using contours and orders them like detection.predefined_rois
+    (dire from right to left, then radiant from right to left).
+    
+    Args:
+        img (array): An array representing the whole screen (obtained through detection.make_screenshot function)
+    
+    Returns:
+        list[array(int)]: List of ROI polygons or None if not every portrait was found
+    """
+    rois = detection.get_hero_rois(img)
+    if len(rois) != 10:
+        return None
+    return sorted(rois, key=lambda roi: roi[..., 0].min(), reverse=True)
+
+
+def read_layouts(path_layouts):
+    """Reads cached layouts from file.
+    
+    Args:
+        path_layouts (str): Path to the layout cache file
+    
+    Returns:
+        dict{str: list[array(int)]}: ROI polygons for each layout key
+    """
+    key_file = str(path_layouts)
+    if key_file not in _layouts:
+        layouts = {}
+        if os.path.exists(path_layouts):
+            with open(path_layouts, 'r', encoding='utf-8') as fp:
+                for key, rois in json.load(fp).items():
+                    layouts[key] = [np.array(roi, np.int32).reshape(1, -1, 2) for roi in rois]
+        _layouts[key_file] = layouts
+    return _layouts[key_file]
+
+
+def save_layout(path_layouts, key, rois):
+    """Adds a layout to the cache file.
+    
+    Args:
+        path_layouts (str): Path to the layout cache file
+        key (str): Layout key (obtained through layout_key function)
+        rois (list[array(int)]): List of ROI polygons
+    """
+    layouts = read_layouts(path_layouts)
+    layouts[key] = rois
+
+    data = {k: [roi.reshape(-1, 2).tolist() for roi in v] for k, v in layouts.items()}
+    with open(path_layouts, 'w', encoding='utf-8') as fp:
+        json.dump(data, fp, indent=2)
+
+
+def layout_key(monitor_number, screenshot_path, width, height):
+    """Creates the key a layout is cached under.
+    
+    Args:
+        monitor_number (int): Number of the monitor (only used when screenshot_path is "live")
+        screenshot_path (str): Either "live" to capture the screen or a path to the image to load from file
+        width (int): Width of the screen in pixels
+        height (int): Height of the screen in pixels
+    
+    Returns:
+        str: Layout key
+    """
+    source = f'monitor {monitor_number}' if screenshot_path == 'live' else 'file'
+    return f'{source} {width}x{height}'
+
+
+def get_rois(monitor_number, screenshot_path, roi_method, path_layouts):
+    """Gets ROI polygons of hero portraits for the current resolution.
+    With "predefined" method the full HD coordinates are scaled to the resolution. With "auto" method the portraits are found
+    using contours once, the result is cached for the monitor and resolution and reused afterwards. Until the calibration
+    succeeds (the pick phase has to be on the screen), the scaled predefined coordinates are used.
+    
+    Args:
+        monitor_number (int): Number of the monitor (only used when screenshot_path is "live")
+        screenshot_path (str): Either "live" to capture the screen or a path to the image to load from file
+        roi_method (str): The method to get ROIs, has to be either "predefined" or "auto"
+        path_layouts (str): Path to the layout cache file
+    
+    Returns:
+        list[array(int)]: List of ROI polygons in screen coordinates
+    """
+    width, height = get_resolution(monitor_number, screenshot_path)
+    if roi_method == 'auto':
+        key = layout_key(monitor_number, screenshot_path, width, height)
+        layouts = read_layouts(path_layouts)
+        if key in layouts:
+            return layouts[key]
+
+        rois = calibrate(detection.make_screenshot(monitor_number, screenshot_path))
+        if rois is not None:
+            print(f'Calibrated hero portraits for {key}')
+            save_layout(path_layouts, key, rois)
+            return rois
+
+    return scale_rois(detection.predefined_rois(), width, height)
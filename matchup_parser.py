@@ -0,0 +1,164 @@
+import argparse
+import codecs
+import gzip
+import json
+import re
+import time
+import tracemalloc
+from array import array
+
+import numpy as np
+
+import stats
+from misc import Error
+
+
+# Size in bytes of the chunks a response body or a file is read in
+CHUNK_SIZE = 64 * 1024
+
+# A match up list key or a match up object (an object without nested objects or lists)
+TOKEN = re.compile(r'"(vs|with)"\s*:|\{[^{}\[\]]*\}')
+FIELD = re.compile(r'"(heroId1|heroId2|synergy)"\s*:\s*(-?[0-9][0-9.eE+-]*)')
+
+# Longest token an unfinished tail of a chunk is kept for, match up objects are much shorter
+MAX_TOKEN = 512
+
+
+class MatchupParser:
+    """Incremental parser of a match up response (see queries.make_heroes_matchup_query function). The JSON is scanned chunk by
+    chunk for the "vs" and "with" lists and the pair values are written straight into typed arrays, so the whole JSON tree is never
+    built. Works on any JSON containing the match up lists, e.g. a response body or a cache entry.
+    """
+
+    def __init__(self):
+        """Creates a parser with no data.
+        """
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._text = ''
+        self._key = None
+        self._pairs = {key: (array('i'), array('i'), array('f')) for key in ('vs', 'with')}
+
+    def scan(self, final=False):
+        """Parses the complete tokens of the decoded text.
+        
+        Args:
+            final (bool, optional): If True, the text is the end of the JSON and nothing is kept for the next chunk
+        """
+        end = 0
+        for token in TOKEN.finditer(self._text):
+            end = token.end()
+            if token.group(1):
+                self._key = token.group(1)
+                continue
+            fields = dict(FIELD.findall(token.group(0)))
+            if self._key is None or len(fields) < 3:
+                continue
+            ids_1, ids_2, values = self._pairs[self._key]
+            ids_1.append(int(fields['heroId1']))
+            ids_2.append(int(fields['heroId2']))
+            values.append(float(fields['synergy']))
+        # Only the tail that may hold an unfinished token is kept for the next chunk
+        self._text = '' if final else self._text[max(end, len(self._text) - MAX_TOKEN):]
+
+    def feed(self, chunk):
+        """Parses the next part of the JSON.
+        
+        Args:
+            chunk (bytes): Next bytes of the UTF-8 encoded JSON
+        """
+        self._text += self._decoder.decode(chunk)
+        self.scan()
+
+    def close(self):
+        """Finishes parsing.
+        
+        Returns:
+            tuple(tuple(array, array, array), tuple(array, array, array)): First hero IDs, second hero IDs and values of counter and
+                synergy pairs (like stats.matchup_arrays function)
+        
+        Raises:
+            Error: Error indicating the JSON doesn't contain any match up
+        """
+        self._text += self._decoder.decode(b'', final=True)
+        self.scan(final=True)
+        if not any(len(values) for ids_1, ids_2, values in self._pairs.values()):
+            raise Error('No match up data found in the Stratz response')
+        return tuple((np.frombuffer(ids_1, np.intc).astype(np.int32), np.frombuffer(ids_2, np.intc).astype(np.int32),
+                      np.frombuffer(values, np.float32).copy())
+                     for ids_1, ids_2, values in self._pairs.values())
+
+
+def parse_file(path):
+    """Parses match ups from a JSON file (optionally gzipped) without loading it whole.
+    
+    Args:
+        path (str): Path to the file
+    
+    Returns:
+        tuple(tuple(array, array, array), tuple(array, array, array)): Counter and synergy pairs (see MatchupParser.close function)
+    """
+    parser = MatchupParser()
+    with (gzip.open if str(path).endswith('.gz') else open)(path, 'rb') as fp:
+        while chunk := fp.read(CHUNK_SIZE):
+            parser.feed(chunk)
+    return parser.close()
+
+
+def parse_file_json(path):
+    """Parses match ups from a JSON file (optionally gzipped) by loading the whole JSON tree, the way they were parsed before.
+    
+    Args:
+        path (str): Path to the file
+    
+    Returns:
+        tuple(tuple(array, array, array), tuple(array, array, array)): Counter and synergy pairs (see stats.matchup_arrays function)
+    """
+    with (gzip.open if str(path).endswith('.gz') else open)(path, 'rt', encoding='utf-8') as fp:
+        data = json.load(fp)
+    return stats.matchup_arrays(data['data']['heroStats']['matchUp'])
+
+
+def measure(parse, *args):
+    """Runs a parse function while tracing its memory allocations.
+    
+    Args:
+        parse (function): The parse function
+        *args: Arguments passed to the parse function
+    
+    Returns:
+        tuple(Any, float, int): Result of the function, its duration in seconds and its peak of allocated memory in bytes
+    """
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = parse(*args)
+        duration = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, duration, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares parsing a match up response as a whole JSON tree and as a stream.')
+    parser.add_argument('path', help='match up response body or cache entry (in the stratz_cache folder), optionally gzipped')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each method, the fastest is reported')
+    args = parser.parse_args()
+
+    results = {}
+    for name, parse in (('json', parse_file_json), ('stream', parse_file)):
+        runs = [measure(parse, args.path) for _ in range(args.repeat)]
+        result = runs[0][0]
+        duration = min(run[1] for run in runs)
+        peak = max(run[2] for run in runs)
+        results[name] = result
+        pairs = sum(len(values) for ids_1, ids_2, values in result)
+        print(f'{name:<8}{duration * 1000:>10.1f} ms{peak / 2 ** 20:>10.2f} MiB peak{pairs:>10} pairs')
+
+    same = all(np.array_equal(a, b) for json_pairs, stream_pairs in zip(results['json'], results['stream'])
+               for a, b in zip(json_pairs, stream_pairs))
+    print(f'Same pairs: {same}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,11 @@
 import aiohttp
+import asyncio
+import re
 import socket
+import time
+from collections import deque
 from misc import Error
+from request_policy import RequestPolicy
 
 
 def make_hero_info_query():
@@ -133,42 +138,371 @@ def make_player_winrates_query(player_id, hero_count):
     '''
 
 
-async def run_query(query, stratz_token):
-    """Creates connection to the Stratz's GraphQL API and executed the given query string.
+def query_field(query):
+    """Splits a query string into the name of its top level field and the field's selection.
+    
+    Args:
+        query (str): Query string with a single top level field (created by the make_*_query functions)
+    
+    Returns:
+        tuple(str, str): Name of the field and the field including its arguments and selection
+    
+    Raises:
+        Error: Error indicating the query string doesn't consist of a single top level field
+    """
+    body = query.strip()
+    match = re.fullmatch(r'\{\s*(([_A-Za-z][_0-9A-Za-z]*).*)\}', body, re.DOTALL)
+    if match is None:
+        raise Error(f'Query can\'t be batched:\n{query}')
+    return match.group(2), match.group(1).strip()
+
+
+def split_query_fields(query):
+    """Splits a query string into its top level fields, so a batch query (see make_batch_query function) can be handled field by
+    field.
     
     Args:
         query (str): Query string passed to GraphQL API
-        stratz_token (str): Player's Stratz token
     
     Returns:
-        json: Data of the query result
+        list[tuple(str, str, str)]: Key of each field in the result (its alias or name), its name and the field including its
+            arguments and selection, without the alias
     
     Raises:
-        Error: Error indicating failure to connect to the GraphQL API or erroneous query string
+        Error: Error indicating the query string isn't enclosed in braces
     """
-    connector = aiohttp.TCPConnector(
-        family=socket.AF_INET,
-        ssl=False,
-    )
-
-    async with aiohttp.ClientSession(connector=connector) as session:
-        async def make_request(api):
-            resp = await session.get(
-                f'{api}?query={query}',
-                headers = {
-                    'Authorization': f'Bearer {stratz_token}',
-                    'content-type': 'application/json'
-                }
+    body = query.strip()
+    if not (body.startswith('{') and body.endswith('}')):
+        raise Error(f'Query can\'t be split:\n{query}')
+    body = body[1:-1]
+
+    fields = []
+    depth = 0
+    start = 0
+    in_string = False
+    for idx, char in enumerate(body):
+        if in_string:
+            in_string = char != '"' or body[idx - 1] == '\\'
+        elif char == '"':
+            in_string = True
+        elif char in '{(':
+            depth += 1
+        elif char in '})':
+            depth -= 1
+            # A field ends with the end of its selection
+            if depth == 0 and char == '}':
+                fields.append(body[start: idx + 1])
+                start = idx + 1
+
+    result = []
+    for field in fields:
+        match = re.fullmatch(r'\s*(?:([_A-Za-z][_0-9A-Za-z]*)\s*:)?\s*(([_A-Za-z][_0-9A-Za-z]*).*)', field, re.DOTALL)
+        if match is None:
+            raise Error(f'Query can\'t be split:\n{query}')
+        alias, text, name = match.groups()
+        result.append((alias or name, name, text.strip()))
+    return result
+
+
+def make_batch_query(queries):
+    """Combines several query strings into one. The top level field of each query gets an alias by its index, so the same field
+    (e.g. heroStats of different positions) can be queried more than once.
+    
+    Args:
+        queries (list[str]): Query strings created by the make_*_query functions
+    
+    Returns:
+        str: query string
+    """
+    fields = [f'q{idx}: {query_field(query)[1]}' for idx, query in enumerate(queries)]
+    return '{\n' + '\n'.join(fields) + '\n}'
+
+
+def split_batch_result(queries, data):
+    """Splits the result of a batch query (see make_batch_query function) into the results of each query, as if they were
+    queried one by one.
+    
+    Args:
+        queries (list[str]): Query strings the batch query was created from
+        data (json): Data of the batch query result
+    
+    Returns:
+        list[json]: Data of each query's result
+    """
+    return [{query_field(query)[0]: data[f'q{idx}']} for idx, query in enumerate(queries)]
+
+
+# Size in bytes of the chunks streamed responses are parsed in
+STREAM_CHUNK_SIZE = 64 * 1024
+
+STRATZ_APIS = ['https://api.stratz.com/graphql', 'https://apibeta.stratz.com/graphql']
+
+
+class StratzClient:
+    """Long-lived client of the Stratz's GraphQL API. Connections are kept alive and reused by later queries, up to the
+    given number of connections at once. Has to be closed (or used as an async context manager) to release the connections.
+    
+    Attributes:
+        timings (collections.deque[dict]): Durations in seconds of the latest requests: DNS lookup ("dns"), TCP and TLS handshake
+            ("connect", 0 for reused connections), waiting for the response headers ("wait"), reading the body ("transfer") and
+            the whole request ("total"), with the URL ("url") and whether the connection was reused ("reused")
+    """
+
+    def __init__(self, stratz_token, limit=4, max_queries=4, history=100, policy=None, apis=None, recorder=None):
+        """Creates the client, the connection pool is created with the first query.
+        
+        Args:
+            stratz_token (str): Player's Stratz token
+            limit (int, optional): Maximal number of simultaneous connections
+            max_queries (int, optional): Maximal number of queries running at once, others wait for them to finish
+            history (int, optional): Number of latest requests whose timings are kept
+            policy (request_policy.RequestPolicy, optional): Timeouts, retries, hedging and rate limit of requests
+            apis (list[str], optional): URLs of the primary and the fallback GraphQL API, by default the Stratz ones
+            recorder (stratz_stub.Recording, optional): Recording every successful query result is saved to
+        """
+        self.stratz_token = stratz_token
+        self.limit = limit
+        self.policy = policy or RequestPolicy()
+        self.apis = apis or STRATZ_APIS
+        self.recorder = recorder
+        self._queries = asyncio.Semaphore(max_queries)
+        self.timings = deque(maxlen=history)
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _trace_config(self):
+        # Marks the time of each connection stage in the context passed to the request
+        trace_config = aiohttp.TraceConfig()
+
+        def mark(name):
+            async def on_event(session, context, params):
+                context.trace_request_ctx[name] = time.perf_counter()
+            return on_event
+
+        trace_config.on_dns_resolvehost_start.append(mark('dns_start'))
+        trace_config.on_dns_resolvehost_end.append(mark('dns_end'))
+        trace_config.on_connection_create_start.append(mark('connect_start'))
+        trace_config.on_connection_create_end.append(mark('connect_end'))
+        trace_config.on_request_end.append(mark('headers'))
+        return trace_config
+
+    def session(self):
+        """Gets the shared session, creating it on first use.
+        
+        Returns:
+            aiohttp.ClientSession: The session
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                family=socket.AF_INET,
+                ssl=False,
+                limit=self.limit,
             )
+            self._session = aiohttp.ClientSession(connector=connector, trace_configs=[self._trace_config()])
+        return self._session
 
-            return await resp.json()
+    async def request(self, api, query, make_parser=None):
+        """Sends a query to the given API URL and records the timings of the request.
+        
+        Args:
+            api (str): URL of the GraphQL API
+            query (str): Query string passed to GraphQL API
+            make_parser (function, optional): A function() -> parser with feed(bytes) and close() functions, the response body is
+                fed to a new parser as it arrives instead of being parsed as a whole
+        
+        Returns:
+            json: The whole response, with the result of the parser as "data" if one is given
+        """
+        marks = {}
+        start = time.perf_counter()
+        async with self.session().post(
+            api,
+            json={'query': query},
+            headers = {
+                'Authorization': f'Bearer {self.stratz_token}',
+            },
+            trace_request_ctx=marks,
+        ) as resp:
+            headers = marks.get('headers', time.perf_counter())
+            resp.raise_for_status()
+            if make_parser is None:
+                data = await resp.json()
+            else:
+                parser = make_parser()
+                async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    parser.feed(chunk)
+                data = {'data': parser.close()}
+        end = time.perf_counter()
 
+        dns = marks['dns_end'] - marks['dns_start'] if 'dns_end' in marks else 0
+        connect = marks['connect_end'] - marks['connect_start'] if 'connect_end' in marks else 0
+        self.timings.append({
+            'url': api,
+            'reused': 'connect_end' not in marks,
+            'dns': dns,
+            'connect': connect - dns,
+            'wait': headers - start - connect,
+            'transfer': end - headers,
+            'total': end - start,
+        })
+        return data
+
+    async def attempt(self, api, query, make_parser=None):
+        """Sends a query to the given API URL once, respecting the rate limit and the timeout of the policy.
+        
+        Args:
+            api (str): URL of the GraphQL API
+            query (str): Query string passed to GraphQL API
+            make_parser (function, optional): A function() -> streaming parser of the response body (see request function)
+        
+        Returns:
+            json: Data of the query result
+        """
+        await self.policy.wait_turn()
+        response = await asyncio.wait_for(self.request(api, query, make_parser), self.policy.timeout)
+        return response['data']
+
+    async def hedged_attempt(self, query, make_parser=None):
+        """Sends a query to the primary API and, if it doesn't answer within the hedging delay of the policy (or fails),
+        to the fallback API as well. The first successful answer is used and the other request is cancelled.
+        
+        Args:
+            query (str): Query string passed to GraphQL API
+            make_parser (function, optional): A function() -> streaming parser of the response body (see request function)
+        
+        Returns:
+            json: Data of the query result
+        """
+        primary, fallback = self.apis[0], self.apis[-1]
+        latencies = [timing['total'] for timing in self.timings if timing['url'] == primary]
+        tasks = [asyncio.create_task(self.attempt(primary, query, make_parser))]
         try:
-            data = (await make_request('https://api.stratz.com/graphql'))['data']
-        except:
-            try:
-                data = (await make_request('https://apibeta.stratz.com/graphql'))['data']
-            except Exception as e:
-                raise Error(f'Failed to parse data from Stratz. The API may be down, your connection unstable, '
-                            f'or something else. Exact error:\n\n{e}\n\nData:{data}')
+            done, pending = await asyncio.wait(tasks, timeout=self.policy.hedge_after(latencies))
+            if not done or tasks[0].exception() is not None:
+                tasks.append(asyncio.create_task(self.attempt(fallback, query, make_parser)))
+
+            errors = []
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    errors.append(task.exception())
+            raise errors[-1]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def record(self, query, data):
+        """Saves a query result to the recorder, if there is one.
+        
+        Args:
+            query (str): Query string passed to GraphQL API
+            data (json): Data of the query result
+        
+        Returns:
+            json: The given data
+        """
+        if self.recorder is not None:
+            self.recorder.record(query, data)
         return data
+
+    async def run_query(self, query, make_parser=None):
+        """Executes the given query string. Each attempt tries the main API and falls back to the beta API if it fails (or, when
+        hedging, if it's slow), failed attempts are retried after a jittered exponential backoff.
+        
+        Args:
+            query (str): Query string passed to GraphQL API
+            make_parser (function, optional): A function() -> streaming parser of the response body (see request function), each
+                attempt gets a new parser. Streamed results are not recorded
+        
+        Returns:
+            json: Data of the query result, or the result of the parser
+        
+        Raises:
+            Error: Error indicating failure to connect to the GraphQL API or erroneous query string
+        """
+        # Results of streaming parsers aren't JSON, so only JSON results are recorded
+        record = self.record if make_parser is None else lambda query, data: data
+        errors = []
+        async with self._queries:
+            for attempt in range(self.policy.retries + 1):
+                if attempt:
+                    await asyncio.sleep(self.policy.backoff_delay(attempt - 1))
+
+                if self.policy.hedge and len(self.apis) > 1:
+                    try:
+                        return record(query, await self.hedged_attempt(query, make_parser))
+                    except Exception as e:
+                        errors.append(f'attempt {attempt + 1}: {e!r}')
+                    continue
+
+                for api in self.apis:
+                    try:
+                        return record(query, await self.attempt(api, query, make_parser))
+                    except Exception as e:
+                        errors.append(f'attempt {attempt + 1}, {api}: {e!r}')
+        raise Error('Failed to parse data from Stratz. The API may be down, your connection unstable, '
+                    'or something else. Exact errors:\n\n' + '\n'.join(errors))
+
+    async def run_batch(self, queries):
+        """Executes several query strings in a single request (see make_batch_query function).
+        
+        Args:
+            queries (list[str]): Query strings created by the make_*_query functions
+        
+        Returns:
+            list[json]: Data of each query's result
+        
+        Raises:
+            Error: Error indicating failure to connect to the GraphQL API or erroneous query string
+        """
+        if len(queries) == 1:
+            return [await self.run_query(queries[0])]
+        return split_batch_result(queries, await self.run_query(make_batch_query(queries)))
+
+    def timing_summary(self):
+        """Sums up the timings of the latest requests.
+        
+        Returns:
+            dict: Number of requests ("requests") and new connections ("connections"), and the total duration in seconds of
+                handshakes ("connect"), waiting ("wait") and transfers ("transfer")
+        """
+        return {
+            'requests': len(self.timings),
+            'connections': sum(1 for timing in self.timings if not timing['reused']),
+            'connect': sum(timing['dns'] + timing['connect'] for timing in self.timings),
+            'wait': sum(timing['wait'] for timing in self.timings),
+            'transfer': sum(timing['transfer'] for timing in self.timings),
+        }
+
+    async def close(self):
+        """Closes the session and its connections.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+async def run_query(query, stratz_token):
+    """Creates connection to the Stratz's GraphQL API and executed the given query string. Use StratzClient to run more queries
+    over the same connections.
+    
+    Args:
+        query (str): Query string passed to GraphQL API
+        stratz_token (str): Player's Stratz token
+    
+    Returns:
+        json: Data of the query result
+    
+    Raises:
+        Error: Error indicating failure to connect to the GraphQL API or erroneous query string
+    """
+    async with StratzClient(stratz_token, limit=1) as client:
+        return await client.run_query(query)
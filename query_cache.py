@@ -0,0 +1,354 @@
+import aiohttp
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import time
+import zlib
+from pathlib import Path
+
+from misc import Error
+
+
+class CachingParser:
+    """Streaming parser that also compresses the response body it's fed, so the body can be cached once parsing succeeds.
+    
+    Attributes:
+        parser (Any): The wrapped parser with feed(bytes) and close() functions
+        path (Path): Cache file the body is written to
+    """
+
+    def __init__(self, parser, path):
+        """Wraps a parser.
+        
+        Args:
+            parser (Any): The wrapped parser with feed(bytes) and close() functions
+            path (Path): Cache file the body is written to
+        """
+        self.parser = parser
+        self.path = path
+        # Compressed body is kept in memory until the response is complete, it's much smaller than the parsed JSON tree
+        self._compressor = zlib.compressobj(wbits=31)
+        self._chunks = []
+
+    def feed(self, chunk):
+        """Parses and compresses the next part of the body.
+        
+        Args:
+            chunk (bytes): Next bytes of the body
+        """
+        self._chunks.append(self._compressor.compress(chunk))
+        self.parser.feed(chunk)
+
+    def close(self):
+        """Finishes parsing and writes the cache file, the file is only replaced if parsing succeeded.
+        
+        Returns:
+            Any: Result of the wrapped parser
+        """
+        result = self.parser.close()
+        self._chunks.append(self._compressor.flush())
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp, 'wb') as fp:
+            fp.writelines(self._chunks)
+        os.replace(tmp, self.path)
+        return result
+
+
+class QueryCache:
+    """On-disk cache of Stratz query results. Each result is stored as a gzipped JSON file named after the hash of its query.
+    Results younger than the TTL of their kind are returned without a request. Older results are still returned right away
+    (unless they are older than the TTL and max_stale together), while a fresh copy is downloaded in the background.
+    
+    Attributes:
+        client (queries.StratzClient): Client used to download results
+        path (Path): Folder containing the cached results
+        enabled (bool): If False, every query is sent to Stratz and nothing is stored
+        ttls (dict{str: float}): Time in seconds after which results of each kind are refreshed
+        max_stale (float): Time in seconds after the TTL during which an outdated result is still returned
+    """
+
+    def __init__(self, client, path, enabled=True, ttls=None, max_stale=0):
+        """Creates the cache, the folder is created with the first stored result.
+        
+        Args:
+            client (queries.StratzClient): Client used to download results
+            path (str): Folder containing the cached results
+            enabled (bool, optional): If False, every query is sent to Stratz and nothing is stored
+            ttls (dict{str: float}, optional): Time in seconds after which results of each kind are refreshed, a day by default
+            max_stale (float, optional): Time in seconds after the TTL during which an outdated result is still returned
+        """
+        self.client = client
+        self.path = Path(path)
+        self.enabled = enabled
+        self.ttls = ttls or {}
+        self.max_stale = max_stale
+        # Background refreshes, referenced so they are not garbage collected while running
+        self._refreshes = {}
+
+    def entry_path(self, query):
+        """Gets the file a query result is stored in. Queries differing only in whitespace share the file.
+        
+        Args:
+            query (str): Query string passed to GraphQL API
+        
+        Returns:
+            Path: Path to the cache file
+        """
+        digest = hashlib.sha1(' '.join(query.split()).encode('utf-8')).hexdigest()
+        return self.path / f'{digest}.json.gz'
+
+    def body_path(self, query):
+        """Gets the file the response body of a streamed query is stored in (see run_stream function).
+        
+        Args:
+            query (str): Query string passed to GraphQL API
+        
+        Returns:
+            Path: Path to the cache file
+        """
+        path = self.entry_path(query)
+        return path.with_name(path.name.replace('.json.gz', '.body.gz'))
+
+    def freshness(self, fetched, kind):
+        """Determines whether a cached result can be used.
+        
+        Args:
+            fetched (float): Time the result was downloaded (as time.time)
+            kind (str): Kind of the query, determines its TTL
+        
+        Returns:
+            str: "fresh" if it's younger than the TTL, "stale" if it can be used while it's refreshed and None if it's too old
+        """
+        age = time.time() - fetched
+        ttl = self.ttls.get(kind, 24 * 60 * 60)
+        if age <= ttl:
+            return 'fresh'
+        if age <= ttl + self.max_stale:
+            return 'stale'
+        return None
+
+    def read(self, query):
+        """Reads a cached query result.
+        
+        Args:
+            query (str): Query string passed to GraphQL API
+        
+        Returns:
+            tuple(float, json): Time the result was downloaded (as time.time) and the result, or None if it isn't cached
+        """
+        try:
+            with gzip.open(self.entry_path(query), 'rt', encoding='utf-8') as fp:
+                entry = json.load(fp)
+            return entry['time'], entry['data']
+        except (OSError, ValueError, KeyError):
+            # Missing or damaged entries are downloaded again
+            return None
+
+    def write(self, query, data):
+        """Stores a query result. The file is replaced atomically, so readers never see a partially written entry.
+        
+        Args:
+            query (str): Query string passed to GraphQL API
+            data (json): Data of the query result
+        """
+        path = self.entry_path(query)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '.tmp')
+        with gzip.open(tmp, 'wt', encoding='utf-8') as fp:
+            json.dump({'time': time.time(), 'data': data}, fp, separators=(',', ':'))
+        os.replace(tmp, path)
+
+    async def fetch(self, queries):
+        """Downloads query results in a single request and stores them.
+        
+        Args:
+            queries (list[str]): Query strings passed to GraphQL API
+        
+        Returns:
+            list[json]: Data of each query's result
+        """
+        results = await self.client.run_batch(queries)
+        if self.enabled:
+            for query, data in zip(queries, results):
+                self.write(query, data)
+        return results
+
+    async def run(self, query, kind, on_refresh=None):
+        """Gets a query result from the cache or from Stratz (see queries.StratzClient.run_query function).
+        
+        Args:
+            query (str): Query string passed to GraphQL API
+            kind (str): Kind of the query, determines its TTL (e.g. "matchups")
+            on_refresh (function, optional): A function(json) called with the fresh result when an outdated result was returned
+        
+        Returns:
+            json: Data of the query result
+        
+        Raises:
+            Error: Error indicating failure to connect to the GraphQL API or erroneous query string
+        """
+        refresh = (lambda idx, data: on_refresh(data)) if on_refresh else None
+        return (await self.run_many([query], kind, refresh))[0]
+
+    async def run_many(self, queries, kinds, on_refresh=None):
+        """Gets several query results from the cache or from Stratz. Results that have to be downloaded are downloaded in a single
+        request (see queries.StratzClient.run_batch function), and so are outdated results refreshed in the background.
+        
+        Args:
+            queries (list[str]): Query strings passed to GraphQL API
+            kinds (str or list[str]): Kind of each query (or of all of them), determines their TTL (e.g. "winrates")
+            on_refresh (function, optional): A function(int, json) called with the index and the fresh result of each query whose
+                outdated result was returned
+        
+        Returns:
+            list[json]: Data of each query's result
+        
+        Raises:
+            Error: Error indicating failure to connect to the GraphQL API or erroneous query string
+        """
+        if isinstance(kinds, str):
+            kinds = [kinds] * len(queries)
+
+        results = [None] * len(queries)
+        missing = []
+        stale = []
+        for idx, (query, kind) in enumerate(zip(queries, kinds)):
+            entry = self.read(query) if self.enabled else None
+            if entry is None:
+                missing.append(idx)
+                continue
+
+            fetched, data = entry
+            state = self.freshness(fetched, kind)
+            if state is None:
+                missing.append(idx)
+                continue
+            results[idx] = data
+            if state == 'stale':
+                stale.append(idx)
+
+        if missing:
+            for idx, data in zip(missing, await self.fetch([queries[idx] for idx in missing])):
+                results[idx] = data
+
+        # Results that are already being refreshed are not refreshed twice
+        stale = [idx for idx in stale if self.entry_path(queries[idx]).name not in self._refreshes]
+        if stale:
+            keys = [self.entry_path(queries[idx]).name for idx in stale]
+            task = asyncio.create_task(self.refresh([queries[idx] for idx in stale], stale, kinds[stale[0]], on_refresh))
+            for key in keys:
+                self._refreshes[key] = task
+            task.add_done_callback(lambda done: [self._refreshes.pop(key, None) for key in keys])
+
+        return results
+
+    async def refresh(self, queries, indexes, kind, on_refresh=None):
+        """Downloads fresh copies of outdated results in the background. On failure the outdated results are kept.
+        
+        Args:
+            queries (list[str]): Query strings passed to GraphQL API
+            indexes (list[int]): Index of each query passed to on_refresh
+            kind (str): Kind of the queries, only used in messages
+            on_refresh (function, optional): A function(int, json) called with the index and the fresh result of each query
+        """
+        try:
+            results = await self.fetch(queries)
+        except (Error, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f'Could not refresh cached {kind} data, using the old copy ({e.__class__.__name__})')
+            return
+        if on_refresh is not None:
+            for idx, data in zip(indexes, results):
+                on_refresh(idx, data)
+
+    def read_stream(self, query, parser):
+        """Feeds a cached response body to a streaming parser.
+        
+        Args:
+            query (str): Query string passed to GraphQL API
+            parser (Any): Parser with feed(bytes) and close() functions
+        
+        Returns:
+            Any: Result of the parser, None if the body isn't cached or can't be parsed
+        """
+        try:
+            with gzip.open(self.body_path(query), 'rb') as fp:
+                while chunk := fp.read(64 * 1024):
+                    parser.feed(chunk)
+            return parser.close()
+        except (OSError, EOFError, zlib.error, Error):
+            # Missing or damaged entries are downloaded again
+            return None
+
+    async def fetch_stream(self, query, make_parser):
+        """Downloads a query result through a streaming parser and stores the response body.
+        
+        Args:
+            query (str): Query string passed to GraphQL API
+            make_parser (function): A function() -> parser with feed(bytes) and close() functions
+        
+        Returns:
+            Any: Result of the parser
+        """
+        if not self.enabled:
+            return await self.client.run_query(query, make_parser)
+        return await self.client.run_query(query, lambda: CachingParser(make_parser(), self.body_path(query)))
+
+    async def run_stream(self, query, kind, make_parser, on_refresh=None):
+        """Gets a query result from the cache or from Stratz like run function, but the response body is fed to a streaming
+        parser instead of being parsed as a whole (see queries.StratzClient.request function). The body is cached as it was
+        received, so cached results are parsed the same way.
+        
+        Args:
+            query (str): Query string passed to GraphQL API
+            kind (str): Kind of the query, determines its TTL (e.g. "matchups")
+            make_parser (function): A function() -> parser with feed(bytes) and close() functions
+            on_refresh (function, optional): A function(Any) called with the fresh result when an outdated result was returned
+        
+        Returns:
+            Any: Result of the parser
+        
+        Raises:
+            Error: Error indicating failure to connect to the GraphQL API or erroneous query string
+        """
+        path = self.body_path(query)
+        try:
+            state = self.freshness(path.stat().st_mtime, kind) if self.enabled else None
+        except OSError:
+            state = None
+        result = self.read_stream(query, make_parser()) if state else None
+        if result is None:
+            return await self.fetch_stream(query, make_parser)
+
+        if state == 'stale' and path.name not in self._refreshes:
+            task = asyncio.create_task(self.refresh_stream(query, kind, make_parser, on_refresh))
+            self._refreshes[path.name] = task
+            task.add_done_callback(lambda done: self._refreshes.pop(path.name, None))
+        return result
+
+    async def refresh_stream(self, query, kind, make_parser, on_refresh=None):
+        """Downloads a fresh copy of an outdated streamed result in the background. On failure the outdated result is kept.
+        
+        Args:
+            query (str): Query string passed to GraphQL API
+            kind (str): Kind of the query, only used in messages
+            make_parser (function): A function() -> parser with feed(bytes) and close() functions
+            on_refresh (function, optional): A function(Any) called with the fresh result
+        """
+        try:
+            result = await self.fetch_stream(query, make_parser)
+        except (Error, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f'Could not refresh cached {kind} data, using the old copy ({e.__class__.__name__})')
+            return
+        if on_refresh is not None:
+            on_refresh(result)
+
+    async def close(self):
+        """Cancels the background refreshes that are still running.
+        """
+        tasks = set(self._refreshes.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,59 @@
+import heapq
+import numpy as np
+
+
+def top_k(items, k=None, key=None):
+    """Returns the k items with the highest key, from the highest. Items with equal keys keep their order, so the result is the
+    same as sorting all items in descending order and taking the first k, but only k items are kept in a heap.
+    
+    Args:
+        items (iterable): Items to rank
+        k (int, optional): Number of items returned, by default all items are ranked
+        key (function, optional): A function(item) -> Any giving the value items are ranked by, by default the item itself
+    
+    Returns:
+        list: The best k items
+    """
+    items = list(items)
+    if k is None or k >= len(items):
+        return sorted(items, key=key, reverse=True)
+    return heapq.nlargest(k, items, key=key)
+
+
+def top_k_indices(values, k=None):
+    """Returns the indexes of the k highest values, from the highest. Equal values keep the order of their indexes, so the result is
+    the same as a stable descending argsort cut to k, but only the values that can be among the best k are sorted.
+    
+    Args:
+        values (array): 1D array of values
+        k (int, optional): Number of indexes returned, by default all values are ranked
+    
+    Returns:
+        array(int): Indexes of the best k values
+    """
+    values = np.asarray(values)
+    if k is None or k >= len(values):
+        return np.argsort(-values, kind='stable')
+    if k <= 0:
+        return np.empty(0, np.intp)
+
+    # Every value equal to the k-th highest one is a candidate, so ties are broken by index like in a stable sort
+    kth = -np.partition(-values, k - 1)[k - 1]
+    candidates = np.flatnonzero(values >= kth)
+    return candidates[np.argsort(-values[candidates], kind='stable')][:k]
+
+
+def id_mask(hero_ids, size):
+    """Creates a boolean mask of hero IDs, so membership of many heroes can be tested at once by indexing.
+    
+    Args:
+        hero_ids (iterable[int]): IDs of heroes in the set
+        size (int): Length of the mask, has to be higher than every ID tested
+    
+    Returns:
+        array(bool): True at the index of each given hero ID
+    """
+    mask = np.zeros(size, bool)
+    hero_ids = np.fromiter(hero_ids, np.intp)
+    mask[hero_ids[(hero_ids >= 0) & (hero_ids < size)]] = True
+    return mask
@@ -0,0 +1,113 @@
+import asyncio
+import random
+import time
+
+
+class RateLimiter:
+    """Token bucket limiting how many requests are sent per second. Up to burst requests can be sent at once, after that
+    requests wait until the bucket refills.
+    
+    Attributes:
+        rate (float): Number of requests allowed per second on average
+        burst (int): Maximal number of requests sent at once
+    """
+
+    def __init__(self, rate, burst=1):
+        """Creates a full bucket.
+        
+        Args:
+            rate (float): Number of requests allowed per second on average
+            burst (int, optional): Maximal number of requests sent at once
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Waits until a request can be sent.
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RequestPolicy:
+    """Settings of how queries are sent: timeouts, retries with backoff, hedging and rate limiting.
+    
+    Attributes:
+        timeout (float): Time in seconds after which a single request is abandoned
+        retries (int): Number of times a failed query is sent again
+        backoff (float): Maximal delay in seconds before the first retry, doubled with each retry
+        max_backoff (float): Upper limit of the delay before a retry
+        hedge (bool): If True, the query is also sent to the fallback API when the primary one is slow, the first answer is used
+        hedge_percentile (float): Percentile (0-100) of the primary API's recent latencies after which the fallback is queried
+        hedge_delay (float): Delay in seconds after which the fallback is queried until enough latencies are known
+        hedge_samples (int): Number of latencies needed before the percentile is used
+        rate_limiter (RateLimiter): Limits the requests per second, None for no limit
+    """
+
+    def __init__(self, timeout=10, retries=2, backoff=0.5, max_backoff=8, hedge=False, hedge_percentile=90, hedge_delay=1.0,
+                 hedge_samples=5, rate_limit=0, burst=1):
+        """Creates the policy.
+        
+        Args:
+            timeout (float, optional): Time in seconds after which a single request is abandoned
+            retries (int, optional): Number of times a failed query is sent again
+            backoff (float, optional): Maximal delay in seconds before the first retry, doubled with each retry
+            max_backoff (float, optional): Upper limit of the delay before a retry
+            hedge (bool, optional): If True, the query is also sent to the fallback API when the primary one is slow
+            hedge_percentile (float, optional): Percentile (0-100) of the primary API's recent latencies after which the fallback is queried
+            hedge_delay (float, optional): Delay in seconds after which the fallback is queried until enough latencies are known
+            hedge_samples (int, optional): Number of latencies needed before the percentile is used
+            rate_limit (float, optional): Maximal number of requests per second, 0 for no limit
+            burst (int, optional): Maximal number of requests sent at once when rate limited
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.hedge_samples = hedge_samples
+        self.rate_limiter = RateLimiter(rate_limit, burst) if rate_limit > 0 else None
+
+    def backoff_delay(self, attempt):
+        """Computes the delay before a retry. The delay is random between 0 and an exponentially growing limit ("full jitter"),
+        so clients failing at the same time don't retry at the same time.
+        
+        Args:
+            attempt (int): Number of the failed attempt, starting at 0
+        
+        Returns:
+            float: Delay in seconds
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def hedge_after(self, latencies):
+        """Computes how long to wait for the primary API before querying the fallback.
+        
+        Args:
+            latencies (list[float]): Recent durations in seconds of successful requests to the primary API
+        
+        Returns:
+            float: Delay in seconds
+        """
+        if len(latencies) < self.hedge_samples:
+            return self.hedge_delay
+        latencies = sorted(latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))]
+
+    async def wait_turn(self):
+        """Waits until the rate limit allows another request.
+        """
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire()
@@ -0,0 +1,334 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import numpy as np
+
+import ranking
+import stats
+
+
+# Search problem of a worker process, set by init_worker
+_problem = {}
+
+# How many search nodes are expanded between checks of the deadline
+DEADLINE_CHECK_NODES = 64
+
+# Time in seconds the workers are given after the deadline to return their best lineups
+DEADLINE_GRACE = 0.5
+
+# Process pool kept alive between searches, starting processes would take a large part of the time budget
+_executor = {'pool': None, 'workers': 0}
+
+
+def make_problem(meta_heroes, hero_matchups, radiant_heroes, dire_heroes, is_radiant=True, pos=None, responses=0):
+    """Prepares a lineup search: the match up values between all meta heroes that can still be picked and their sums against the
+    heroes picked so far. Heroes are referred to by their index in the "candidates" list.
+    
+    Args:
+        meta_heroes (list[list[tuple(int, float)]]): List of best heroes (their ID and win rate) for each position
+        hero_matchups (dict): Match up matrices (obtained through stats.build_matchup_matrices function)
+        radiant_heroes (list[int]): List of hero indexes for radiant
+        dire_heroes (list[int]): List of hero indexes for dire
+        is_radiant (bool, optional): Determines if picking for radiant side
+        pos (list[int], optional): Positions that are still to be picked, by default includes all positions (1-5)
+        responses (int, optional): Number of enemy picks anticipated after the lineup, each one picked greedily by the enemy
+    
+    Returns:
+        dict: The search problem
+    """
+    if pos is None:
+        pos = [1, 2, 3, 4, 5]
+    allies = radiant_heroes if is_radiant else dire_heroes
+    enemies = dire_heroes if is_radiant else radiant_heroes
+
+    picked = set(allies) | set(enemies)
+    candidates = list(dict.fromkeys(hero for heroes in meta_heroes for hero, win_rate in heroes if hero not in picked))
+    cand_idx = {hero: idx for idx, hero in enumerate(candidates)}
+    pools = [np.array([cand_idx[hero] for hero, win_rate in meta_heroes[p - 1] if hero in cand_idx], np.intp) for p in pos]
+
+    rows = np.array([hero_matchups['rows'][hero] for hero in candidates], np.intp)
+    ally_rows = stats.hero_rows(hero_matchups, allies)
+    enemy_rows = stats.hero_rows(hero_matchups, enemies)
+    mat_vs = hero_matchups['vs'].astype(np.float64)
+    mat_with = hero_matchups['with'].astype(np.float64)
+
+    # Enemies can only respond with heroes that are not in the lineup
+    responses = max(0, min(responses, 5 - len(enemies), len(candidates) - len(pos)))
+
+    return {
+        'candidates': candidates,
+        'pos': list(pos),
+        'pools': pools,
+        'n_allies': len(allies),
+        'n_enemies': len(enemies),
+        'responses': responses,
+        'vs': mat_vs[np.ix_(rows, rows)],
+        'with': mat_with[np.ix_(rows, rows)],
+        # Counter of each candidate against the enemies and synergy with the allies
+        'vs_enemies': mat_vs[np.ix_(rows, enemy_rows)].sum(axis=1),
+        'with_allies': mat_with[np.ix_(rows, ally_rows)].sum(axis=1),
+        # Counter of each candidate against the allies and synergy with the enemies, used for enemy responses
+        'vs_allies': mat_vs[np.ix_(rows, ally_rows)].sum(axis=1),
+        'with_enemies': mat_with[np.ix_(rows, enemy_rows)].sum(axis=1),
+    }
+
+
+def prepare_bounds(problem):
+    """Splits the lineup value into a value of each hero and a value of each pair of heroes, which is exact without enemy
+    responses and an upper bound with them. Adds the values and the best pair value of each hero with each position to the problem.
+    
+    Args:
+        problem (dict): The search problem (obtained through make_problem function)
+    """
+    size = len(problem['pos'])
+    n_syn = problem['n_allies'] + size - 1
+    n_cntr = problem['n_enemies'] + problem['responses']
+
+    counter = problem['vs_enemies']
+    if problem['responses']:
+        # Enemy responses are at best the heroes this hero counters the most
+        counter = counter + -np.sort(-problem['vs'], axis=1)[:, :problem['responses']].sum(axis=1)
+    counter = counter / n_cntr if n_cntr else np.zeros_like(counter)
+    synergy = problem['with_allies'] / n_syn if n_syn else np.zeros_like(counter)
+
+    pair = (problem['with'] + problem['with'].T) / (2 * n_syn) if n_syn else np.zeros_like(problem['with'])
+    np.fill_diagonal(pair, 0)
+
+    problem['unary'] = (counter + synergy) / 2
+    problem['pair'] = pair
+    problem['pair_max'] = np.stack([pair[:, pool].max(axis=1) if len(pool) else np.zeros(len(pair)) for pool in problem['pools']], axis=1)
+
+
+def respond(problem, lineup):
+    """Picks the enemy responses to a lineup greedily, each one maximizing the enemy's averaged counter and synergy value.
+    
+    Args:
+        problem (dict): The search problem (obtained through make_problem function)
+        lineup (list[int]): Candidate indexes of the lineup
+    
+    Returns:
+        list[int]: Candidate indexes of the enemy picks
+    """
+    n_team = problem['n_allies'] + len(lineup)
+    counter = (problem['vs_allies'] + problem['vs'][:, lineup].sum(axis=1)) / n_team if n_team else np.zeros(len(problem['vs']))
+    with_sum = problem['with_enemies'].copy()
+    n_enemies = problem['n_enemies']
+
+    available = np.ones(len(counter), bool)
+    available[lineup] = False
+    picks = []
+    for _ in range(problem['responses']):
+        synergy = with_sum / n_enemies if n_enemies else 0
+        hero = int(np.argmax(np.where(available, counter + synergy, -np.inf)))
+        picks.append(hero)
+        available[hero] = False
+        with_sum += problem['with'][:, hero]
+        n_enemies += 1
+    return picks
+
+
+def evaluate(problem, lineup):
+    """Computes the values of a complete lineup, after the anticipated enemy responses.
+    
+    Args:
+        problem (dict): The search problem (obtained through make_problem function)
+        lineup (list[int]): Candidate indexes of the lineup, one for each position
+    
+    Returns:
+        tuple(float, array, array, list[int]): Value of the lineup, average counter and synergy of each hero and the enemy responses
+    """
+    lineup = np.array(lineup, np.intp)
+    picks = respond(problem, lineup) if problem['responses'] else []
+
+    n_syn = problem['n_allies'] + len(lineup) - 1
+    n_cntr = problem['n_enemies'] + len(picks)
+    counter = problem['vs_enemies'][lineup] + problem['vs'][np.ix_(lineup, picks)].sum(axis=1)
+    counter = counter / n_cntr if n_cntr else np.zeros(len(lineup))
+    synergy = problem['with_allies'][lineup] + problem['with'][np.ix_(lineup, lineup)].sum(axis=1) - problem['with'][lineup, lineup]
+    synergy = synergy / n_syn if n_syn else np.zeros(len(lineup))
+
+    return float(((counter + synergy) / 2).sum()), counter, synergy, picks
+
+
+def greedy_lineup(problem):
+    """Picks the best available hero for each position in turn, used as the first solution of the search.
+    
+    Args:
+        problem (dict): The search problem (obtained through make_problem function, with prepare_bounds applied)
+    
+    Returns:
+        list[int]: Candidate indexes of the lineup, None if some position has no hero left
+    """
+    lineup = []
+    for pool in problem['pools']:
+        pool = pool[~np.isin(pool, lineup)]
+        if not len(pool):
+            return None
+        vals = problem['unary'][pool] + problem['pair'][np.ix_(pool, lineup)].sum(axis=1)
+        lineup.append(int(pool[np.argmax(vals)]))
+    return lineup
+
+
+def init_worker(problem):
+    """Sets the search problem of a worker process.
+    
+    Args:
+        problem (dict): The search problem (obtained through make_problem function, with prepare_bounds applied)
+    """
+    _problem.clear()
+    _problem.update(problem)
+
+
+def search_subtree(task):
+    """Runs a depth-first branch-and-bound search over the lineups starting with the given hero. Heroes of each position are tried
+    from the most promising, branches whose upper bound can't beat the best lineup found so far are pruned.
+    
+    Args:
+        task (tuple(int, float, float)): Candidate index of the hero for the first position, value of the best known lineup and
+            the time (time.time) after which the search stops
+    
+    Returns:
+        tuple(float, list[int], bool, int): Value of the best lineup found (or -inf), its candidate indexes, whether the subtree was
+            searched completely and the number of expanded nodes
+    """
+    first, incumbent, deadline = task
+    problem = _problem
+    pools, unary, pair, pair_max = problem['pools'], problem['unary'], problem['pair'], problem['pair_max']
+    exact = not problem['responses']
+
+    best = {'value': -np.inf, 'lineup': None}
+    progress = {'nodes': 0, 'complete': True}
+
+    def bound(lineup, value):
+        # Best value each remaining position can add, pairs between remaining positions are split between both heroes
+        remaining = list(range(len(lineup), len(pools)))
+        total = value
+        for q in remaining:
+            pool = pools[q][~np.isin(pools[q], lineup)]
+            if not len(pool):
+                return -np.inf
+            others = [r for r in remaining if r != q]
+            vals = unary[pool] + pair[np.ix_(pool, lineup)].sum(axis=1) + pair_max[np.ix_(pool, others)].sum(axis=1) / 2
+            total += vals.max()
+        return total
+
+    def expand(lineup, value):
+        progress['nodes'] += 1
+        if progress['nodes'] % DEADLINE_CHECK_NODES == 0 and time.time() > deadline:
+            progress['complete'] = False
+        if not progress['complete']:
+            return
+
+        if len(lineup) == len(pools):
+            if not exact:
+                value = evaluate(problem, lineup)[0]
+            if value > max(best['value'], incumbent):
+                best['value'], best['lineup'] = value, list(lineup)
+            return
+
+        if bound(lineup, value) <= max(best['value'], incumbent):
+            return
+
+        pool = pools[len(lineup)]
+        pool = pool[~np.isin(pool, lineup)]
+        gains = unary[pool] + pair[np.ix_(pool, lineup)].sum(axis=1)
+        for idx in ranking.top_k_indices(gains):
+            lineup.append(int(pool[idx]))
+            expand(lineup, value + gains[idx])
+            lineup.pop()
+
+    expand([first], unary[first])
+    return best['value'], best['lineup'], progress['complete'], progress['nodes']
+
+
+def search_tasks(problem, tasks):
+    """Searches the subtrees of several first heroes in a worker process, until they are searched or the deadline passes.
+    
+    Args:
+        problem (dict): The search problem (obtained through make_problem function, with prepare_bounds applied)
+        tasks (list[tuple(int, float, float)]): Tasks of search_subtree function
+    
+    Returns:
+        list[tuple(float, list[int], bool, int)]: Results of search_subtree function for each searched task
+    """
+    init_worker(problem)
+    results = []
+    for task in tasks:
+        results.append(search_subtree(task))
+        if time.time() > task[2]:
+            break
+    return results
+
+
+def get_executor(workers):
+    """Gets the process pool with the given number of workers, which is reused by later searches.
+    
+    Args:
+        workers (int): Number of worker processes
+    
+    Returns:
+        concurrent.futures.ProcessPoolExecutor: The process pool
+    """
+    if _executor['pool'] is None or _executor['workers'] != workers:
+        if _executor['pool'] is not None:
+            _executor['pool'].shutdown(wait=False, cancel_futures=True)
+        _executor['pool'] = ProcessPoolExecutor(max_workers=workers)
+        _executor['workers'] = workers
+    return _executor['pool']
+
+
+def search_lineup(problem, time_budget=2.0, workers=1):
+    """Finds the lineup (one hero for each remaining position) with the best combined counter and synergy value. The search stops
+    when the time budget runs out and returns the best lineup found so far, which is at least as good as the greedy one.
+    The branches of the first position are searched on a process pool if there is more than one worker.
+    
+    Args:
+        problem (dict): The search problem (obtained through make_problem function)
+        time_budget (float, optional): Maximal duration of the search in seconds
+        workers (int, optional): Number of worker processes, 1 searches in the current process
+    
+    Returns:
+        dict: Value of the lineup ("value"), its heroes for each position ("lineup", list of hero ID, counter, synergy and value),
+            the anticipated enemy picks ("responses"), whether the search was complete ("complete") and the number of nodes ("nodes")
+    """
+    deadline = time.time() + time_budget
+    prepare_bounds(problem)
+
+    lineup = greedy_lineup(problem)
+    if lineup is None:
+        return None
+    value = evaluate(problem, lineup)[0]
+    nodes = 0
+
+    # Most promising heroes of the first position are searched first
+    first_pool = problem['pools'][0]
+    firsts = first_pool[ranking.top_k_indices(problem['unary'][first_pool])].tolist()
+    tasks = [(first, value, deadline) for first in firsts]
+
+    if workers > 1 and len(tasks) > 1:
+        # Each worker gets the problem once, with every n-th first hero so each worker starts with a promising one
+        futures = [get_executor(workers).submit(search_tasks, problem, tasks[idx::workers]) for idx in range(min(workers, len(tasks)))]
+        # Workers stop at the deadline by themselves and return their best lineups, so they are waited for a bit longer
+        done, not_done = wait(futures, timeout=max(0, deadline - time.time()) + DEADLINE_GRACE)
+        for future in not_done:
+            future.cancel()
+        results = [result for future in done for result in future.result()]
+    else:
+        results = search_tasks(problem, tasks)
+    complete = len(results) == len(tasks)
+
+    for result_value, result_lineup, result_complete, result_nodes in results:
+        complete = complete and result_complete
+        nodes += result_nodes
+        if result_lineup is not None and result_value > value:
+            value, lineup = result_value, result_lineup
+
+    value, counter, synergy, picks = evaluate(problem, lineup)
+    candidates = problem['candidates']
+    return {
+        'value': value,
+        'lineup': [(candidates[hero], c, s, (c + s) / 2) for hero, c, s in zip(lineup, counter.tolist(), synergy.tolist())],
+        'responses': [candidates[hero] for hero in picks],
+        'complete': complete,
+        'nodes': nodes,
+    }
@@ -1,54 +1,155 @@
+import itertools
+import numpy as np
+from collections import OrderedDict
+
+import ranking
+
+
+# Every set of match up matrices gets a new version, so cached results of older data are never reused
+_matchup_versions = itertools.count(1)
+
+
+def matchup_arrays(matchup_data):
+    """Flattens match up data into arrays of hero pairs and their values.
+    
+    Args:
+        matchup_data (list[json]): Match up data of each hero (the "matchUp" list obtained through queries.make_heroes_matchup_query)
+    
+    Returns:
+        tuple(tuple(array, array, array), tuple(array, array, array)): First hero IDs, second hero IDs and values of counter and synergy pairs
+    """
+    pairs = []
+    for key in ('vs', 'with'):
+        entries = [(matchup['heroId1'], matchup['heroId2'], matchup['synergy']) for hero in matchup_data for matchup in hero[key]]
+        ids_1, ids_2, values = zip(*entries) if entries else ((), (), ())
+        pairs.append((np.array(ids_1, np.int32), np.array(ids_2, np.int32), np.array(values, np.float32)))
+    return tuple(pairs)
+
+
+def build_matchup_matrices(vs_pairs, with_pairs):
+    """Creates dense counter and synergy matrices of all heroes. Row and column i belong to the i-th hero of the "ids" array,
+    hero pairs without data have value 0.
+    
+    Args:
+        vs_pairs (tuple(array, array, array)): First hero IDs, second hero IDs and counter values (obtained through matchup_arrays function)
+        with_pairs (tuple(array, array, array)): First hero IDs, second hero IDs and synergy values (obtained through matchup_arrays function)
+    
+    Returns:
+        dict: Sorted hero IDs ("ids"), row of each hero ID ("rows"), counter matrix ("vs"), synergy matrix ("with") and
+            a number identifying the data ("version")
+    """
+    ids = np.unique(np.concatenate([vs_pairs[0], vs_pairs[1], with_pairs[0], with_pairs[1]]))
+    hero_matchups = {
+        'ids': ids,
+        'rows': {hero_id: row for row, hero_id in enumerate(ids.tolist())},
+        'version': next(_matchup_versions),
+    }
+
+    for key, (ids_1, ids_2, values) in (('vs', vs_pairs), ('with', with_pairs)):
+        mat = np.zeros((len(ids), len(ids)), np.float32)
+        mat[np.searchsorted(ids, ids_1), np.searchsorted(ids, ids_2)] = values
+        hero_matchups[key] = mat
+
+    return hero_matchups
+
+
+def hero_rows(hero_matchups, hero_ids):
+    """Maps hero IDs to rows of the match up matrices, heroes without match up data are left out.
+    
+    Args:
+        hero_matchups (dict): Match up matrices (obtained through build_matchup_matrices function)
+        hero_ids (list[int]): List of hero IDs
+    
+    Returns:
+        array(int): Row of each hero that has match up data
+    """
+    rows = hero_matchups['rows']
+    return np.array([rows[hero_id] for hero_id in hero_ids if hero_id in rows], np.intp)
+
+
 def calc_adv_matrix(radiant_heroes, dire_heroes, hero_matchups):
     """Creates matrices for each radiant hero's counter value against each hero on dire, and synergy matrices between heroes on each team.
     
     Args:
         radiant_heroes (list[int]): List of hero indexes for radiant
         dire_heroes (list[int]): List of hero indexes for dire
-        hero_matchups (dict{int: json}): Match up data for each hero ID (obtained through queries.make_heroes_matchup_query)
+        hero_matchups (dict): Match up matrices (obtained through build_matchup_matrices function)
     
     Returns:
         tuple(list, list, list): 3 matrices (counters, synergy for radiant, synergy for dire)
     """
-    mat_vs = [[0 for col in range(len(dire_heroes))] for row in range(len(radiant_heroes))]
-    mat_with_rad = [[0 for col in range(len(radiant_heroes))] for row in range(len(radiant_heroes))]
-    mat_with_dire = [[0 for col in range(len(dire_heroes))] for row in range(len(dire_heroes))]
-
-    rad_idx = {}
-    dire_idx = {}
-    for idx in range(0, len(radiant_heroes)):
-        rad_idx[radiant_heroes[idx]] = idx
-    for idx in range(0, len(dire_heroes)):
-        dire_idx[dire_heroes[idx]] = idx
-
-    for hero in radiant_heroes:
-        matchups = hero_matchups[hero]['vs']
-
-        for matchup in matchups:
-            if matchup['heroId2'] in dire_heroes:
-                idx_1 = rad_idx[matchup['heroId1']]
-                idx_2 = dire_idx[matchup['heroId2']]
-                mat_vs[idx_1][idx_2] = matchup['synergy']
-
-    for hero in radiant_heroes:
-        matchups = hero_matchups[hero]['with']
-        for matchup in matchups:
-            if matchup['heroId2'] in radiant_heroes:
-                idx_1 = rad_idx[matchup['heroId1']]
-                idx_2 = rad_idx[matchup['heroId2']]
-                mat_with_rad[idx_1][idx_2] = matchup['synergy']
-
-    for hero in dire_heroes:
-        matchups = hero_matchups[hero]['with']
-        for matchup in matchups:
-            if matchup['heroId2'] in dire_heroes:
-                idx_1 = dire_idx[matchup['heroId1']]
-                idx_2 = dire_idx[matchup['heroId2']]
-                mat_with_dire[idx_1][idx_2] = matchup['synergy']
+    rows = hero_matchups['rows']
+    rad_rows = np.array([rows.get(hero, -1) for hero in radiant_heroes], np.intp)
+    dire_rows = np.array([rows.get(hero, -1) for hero in dire_heroes], np.intp)
 
+    def submatrix(mat, rows_1, rows_2):
+        # Heroes without match up data keep their row and column, filled with zeros
+        known_1, known_2 = rows_1 >= 0, rows_2 >= 0
+        sub = np.zeros((len(rows_1), len(rows_2)), np.float32)
+        sub[np.ix_(known_1, known_2)] = mat[np.ix_(rows_1[known_1], rows_2[known_2])]
+        return sub.tolist()
+
+    mat_vs = submatrix(hero_matchups['vs'], rad_rows, dire_rows)
+    mat_with_rad = submatrix(hero_matchups['with'], rad_rows, rad_rows)
+    mat_with_dire = submatrix(hero_matchups['with'], dire_rows, dire_rows)
 
     return mat_vs, mat_with_rad, mat_with_dire
 
 
+def score_drafts(drafts, hero_matchups, chunk_size=65536):
+    """Scores complete drafts: the average counter value of each hero against the enemy team, its average synergy with its
+    teammates and the averaged value of both, plus the averages of each team. Drafts are scored in chunks, so the memory used
+    besides the results doesn't depend on the number of drafts. Heroes without match up data have value 0.
+    
+    Args:
+        drafts (array(int)): Hero IDs of shape (M, 10), radiant heroes in the first 5 columns and dire heroes in the last 5
+            (e.g. a numpy.memmap of recorded matches)
+        hero_matchups (dict): Match up matrices (obtained through build_matchup_matrices function)
+        chunk_size (int, optional): Number of drafts scored at once
+    
+    Returns:
+        dict{str: array}: Counter, synergy and combined value of each hero ("hero_counter", "hero_synergy", "hero_value",
+            shape (M, 10)) and of each team ("team_counter", "team_synergy", "team_value", shape (M, 2), radiant first)
+    """
+    ids = hero_matchups['ids']
+    count = len(ids)
+    # An extra row and column of zeros for heroes without match up data
+    mat_vs = np.zeros((count + 1, count + 1), np.float32)
+    mat_vs[:count, :count] = hero_matchups['vs']
+    mat_with = np.zeros((count + 1, count + 1), np.float32)
+    mat_with[:count, :count] = hero_matchups['with']
+    np.fill_diagonal(mat_with, 0)
+
+    max_id = int(ids.max()) if count else 0
+    lookup = np.full(max_id + 1, count, np.intp)
+    lookup[ids] = np.arange(count)
+
+    num = len(drafts)
+    result = {key: np.empty((num, 10), np.float32) for key in ('hero_counter', 'hero_synergy', 'hero_value')}
+    result.update({key: np.empty((num, 2), np.float32) for key in ('team_counter', 'team_synergy', 'team_value')})
+
+    for start in range(0, num, chunk_size):
+        chunk = np.asarray(drafts[start: start + chunk_size])
+        rows = lookup[np.clip(chunk, 0, max_id)]
+        rows[(chunk < 0) | (chunk > max_id)] = count
+        # Each hero's team is the first or the second half, the enemy team the other one
+        team, enemy = rows, np.concatenate([rows[:, 5:], rows[:, :5]], axis=1)
+        team = team.reshape(-1, 2, 5)
+        enemy = enemy.reshape(-1, 2, 5)
+
+        counter = mat_vs[team[..., :, None], enemy[..., None, :]].mean(axis=-1)
+        synergy = mat_with[team[..., :, None], team[..., None, :]].sum(axis=-1) / 4
+        end = start + len(chunk)
+        result['hero_counter'][start: end] = counter.reshape(-1, 10)
+        result['hero_synergy'][start: end] = synergy.reshape(-1, 10)
+        result['hero_value'][start: end] = ((counter + synergy) / 2).reshape(-1, 10)
+        result['team_counter'][start: end] = counter.mean(axis=-1)
+        result['team_synergy'][start: end] = synergy.mean(axis=-1)
+        result['team_value'][start: end] = ((counter + synergy) / 2).mean(axis=-1)
+
+    return result
+
+
 def get_best_heroes_by_pos(pos_win_rates, pick_thr=0.05, hero_count=10):
     """Returns the meta heroes for each given position based on their win rate. Meta is determined by the hero's pick rate for a given position.
     
@@ -73,75 +174,165 @@ def get_best_heroes_by_pos(pos_win_rates, pick_thr=0.05, hero_count=10):
                 poss[pos].append((hero['heroId'], wr))
 
     for pos, hero_list in enumerate(poss):
-        poss[pos] = sorted(hero_list, key=lambda x: x[1], reverse=True)
-        poss[pos] = poss[pos][:hero_count]
+        poss[pos] = ranking.top_k(hero_list, hero_count, key=lambda x: x[1])
 
     return poss
 
 
-def get_best_pick_by_pos(meta_heroes, hero_matchups, radiant_heroes, dire_heroes, is_radiant=True, pos=None):
+class DraftState:
+    """Running counter and synergy sums of every meta hero against the heroes picked so far. Adding or removing a pick updates
+    the sums of all candidates with a single row of the match up matrices, so suggestions don't have to be recomputed from scratch.
+    
+    Attributes:
+        is_radiant (bool): Determines if picking for radiant side
+        allies (list[int]): IDs of heroes picked by the given team
+        enemies (list[int]): IDs of heroes picked by the opposing team
+    """
+
+    def __init__(self, meta_heroes, hero_matchups, is_radiant=True):
+        """Creates an empty draft.
+        
+        Args:
+            meta_heroes (list[list[tuple(int, float)]]): List of best heroes (their ID and win rate) for each position
+            hero_matchups (dict): Match up matrices (obtained through build_matchup_matrices function)
+            is_radiant (bool, optional): Determines if picking for radiant side
+        """
+        self.is_radiant = is_radiant
+        self.allies = []
+        self.enemies = []
+        self._matchups = hero_matchups
+
+        # Every meta hero is a candidate once, positions refer to the candidates in their meta order
+        self._candidates = list(dict.fromkeys(hero for heroes in meta_heroes for hero, win_rate in heroes))
+        cand_idx = {hero: idx for idx, hero in enumerate(self._candidates)}
+        self._cand_ids = np.array(self._candidates, np.intp)
+        self._id_limit = int(self._cand_ids.max()) + 1 if self._candidates else 1
+        self._cand_rows = np.array([hero_matchups['rows'][hero] for hero in self._candidates], np.intp)
+        self._pos_idx = [np.array([cand_idx[hero] for hero, win_rate in heroes], np.intp) for heroes in meta_heroes]
+
+        self._counter_sum = np.zeros(len(self._candidates))
+        self._synergy_sum = np.zeros(len(self._candidates))
+
+    def _column(self, key, hero):
+        # Values of all candidates with (or against) the hero, heroes without match up data have none
+        row = self._matchups['rows'].get(hero)
+        if row is None:
+            return 0
+        return self._matchups[key][self._cand_rows, row]
+
+    def add_ally(self, hero):
+        """Adds a hero picked by the given team.
+        
+        Args:
+            hero (int): Hero ID
+        """
+        self.allies.append(hero)
+        self._synergy_sum += self._column('with', hero)
+
+    def add_enemy(self, hero):
+        """Adds a hero picked by the opposing team.
+        
+        Args:
+            hero (int): Hero ID
+        """
+        self.enemies.append(hero)
+        self._counter_sum += self._column('vs', hero)
+
+    def remove_ally(self, hero):
+        """Undoes a pick of the given team.
+        
+        Args:
+            hero (int): Hero ID
+        """
+        self.allies.remove(hero)
+        self._synergy_sum -= self._column('with', hero)
+
+    def remove_enemy(self, hero):
+        """Undoes a pick of the opposing team.
+        
+        Args:
+            hero (int): Hero ID
+        """
+        self.enemies.remove(hero)
+        self._counter_sum -= self._column('vs', hero)
+
+    def set_teams(self, radiant_heroes, dire_heroes):
+        """Updates the draft to the given picks, only the heroes that changed are added or removed.
+        
+        Args:
+            radiant_heroes (list[int]): List of hero indexes for radiant
+            dire_heroes (list[int]): List of hero indexes for dire
+        """
+        allies = radiant_heroes if self.is_radiant else dire_heroes
+        enemies = dire_heroes if self.is_radiant else radiant_heroes
+
+        for hero in [hero for hero in self.allies if hero not in allies]:
+            self.remove_ally(hero)
+        for hero in [hero for hero in self.enemies if hero not in enemies]:
+            self.remove_enemy(hero)
+        for hero in allies:
+            if hero not in self.allies:
+                self.add_ally(hero)
+        for hero in enemies:
+            if hero not in self.enemies:
+                self.add_enemy(hero)
+
+    def scores(self):
+        """Computes the average counter and synergy values of every candidate against the current picks.
+        
+        Returns:
+            tuple(array, array, array): Average counter, average synergy and averaged value of each candidate
+        """
+        counter = self._counter_sum / len(self.enemies) if self.enemies else np.zeros(len(self._candidates))
+        synergy = self._synergy_sum / len(self.allies) if self.allies else np.zeros(len(self._candidates))
+        return counter, synergy, (counter + synergy) / 2
+
+    def suggestions(self, pos=None, count=None):
+        """Ranks the heroes that can still be picked for each position.
+        
+        Args:
+            pos (list[int], optional): List of positions to consider, by default includes all positions (1-5)
+            count (int, optional): Number of best heroes returned for each position, by default all of them
+        
+        Returns:
+            list[list[tuple(int, float, float, float)]]: ID, avg counter, avg synergy, averaged value for each hero for each position
+        """
+        if pos is None:
+            pos = [1, 2, 3, 4, 5]
+        counter, synergy, val = self.scores()
+        # Can't pick already picked heroes
+        available = ~ranking.id_mask(self.allies + self.enemies, self._id_limit)[self._cand_ids]
+
+        best_by_pos = [[], [], [], [], []]
+        for p in pos:
+            idx = self._pos_idx[p - 1]
+            idx = idx[available[idx]]
+            # Heroes with equal values keep their meta order
+            idx = idx[ranking.top_k_indices(val[idx], count)]
+            best_by_pos[p - 1] = list(zip(self._cand_ids[idx].tolist(), counter[idx].tolist(),
+                                          synergy[idx].tolist(), val[idx].tolist()))
+
+        return best_by_pos
+
+
+def get_best_pick_by_pos(meta_heroes, hero_matchups, radiant_heroes, dire_heroes, is_radiant=True, pos=None, count=None):
     """Determines the best heroes based on overall best meta heroes and the picked heroes the given team.
     
     Args:
         meta_heroes (list[list[tuple(int, float)]]): List of best heroes (their ID and win rate) for each position
-        hero_matchups (dict{int: json}): Match up data for each hero ID (obtained through queries.make_heroes_matchup_query)
+        hero_matchups (dict): Match up matrices (obtained through build_matchup_matrices function)
         radiant_heroes (list[int]): List of hero indexes for radiant
         dire_heroes (list[int]): List of hero indexes for dire
         is_radiant (bool, optional): Determines if picking for radiant side
         pos (list[int], optional): List of positions to consider, by default includes all positions (1-5)
+        count (int, optional): Number of best heroes returned for each position, by default all of them
     
     Returns:
         list[list[tuple(int, float, float, float)]]: ID, avg counter, avg synergy, averaged value for each hero for each position
     """
-    if pos is None:
-        pos = [1, 2, 3, 4, 5]
-    all_meta_heroes = set()
-
-    for p in range(0, 5):
-        for hero in meta_heroes[p]:
-            all_meta_heroes.add(hero[0])
-
-    against_idx = dire_heroes if is_radiant else radiant_heroes
-    with_idx = radiant_heroes if is_radiant else dire_heroes
-
-    best_heroes = {}
-    for hero in all_meta_heroes:
-        # Can't pick already picked heroes
-        if hero in against_idx or hero in with_idx:
-            continue
-
-        matchups = hero_matchups[hero]
-        data_cntr = matchups['vs']
-        data_syn = matchups['with']
-        
-        counter, synergy = 0, 0
-
-        for matchup in data_cntr:
-            if matchup['heroId2'] in against_idx:
-                counter += matchup['synergy'] / len(against_idx)
-
-        for matchup in data_syn:
-            if matchup['heroId2'] in with_idx:
-                synergy += matchup['synergy'] / len(with_idx)
-
-        val = (counter + synergy) / 2
-
-        best_heroes[hero] = (counter, synergy, val)
-
-    best_by_pos = [[], [], [], [], []]
-    for p in pos:
-        p -= 1
-        for hero in meta_heroes[p]:
-            hero_id = hero[0]
-            # Can't pick already picked heroes
-            if hero_id in against_idx or hero_id in with_idx:
-                continue
-
-            hero_stats = best_heroes[hero_id]
-            best_by_pos[p].append((hero_id, hero_stats[0], hero_stats[1], hero_stats[2]))
-        best_by_pos[p] = sorted(best_by_pos[p], key=lambda x: x[3], reverse=True)
-
-    return best_by_pos
+    draft = DraftState(meta_heroes, hero_matchups, is_radiant)
+    draft.set_teams(radiant_heroes, dire_heroes)
+    return draft.suggestions(pos, count)
 
 
 def include_heroes(meta_heroes, include_ids, hero_count, pos_win_rates):
@@ -160,7 +351,7 @@ def include_heroes(meta_heroes, include_ids, hero_count, pos_win_rates):
 
     # Replace lowest winrate heroes with custom picks and sort again
     for pos in range(0, 5):
-        incl_slice = include_ids[pos][:hero_count]
+        incl_slice = set(include_ids[pos][:hero_count])
         data = pos_win_rates[pos]['heroStats']['winWeek']
         incl_data = []
 
@@ -180,6 +371,130 @@ def include_heroes(meta_heroes, include_ids, hero_count, pos_win_rates):
                 incl_count += 1
             meta_i += 1
 
-        meta_incl_heroes[pos] = sorted(incl_data, key=lambda x: x[1], reverse=True)
+        meta_incl_heroes[pos] = ranking.top_k(incl_data, key=lambda x: x[1])
 
     return meta_incl_heroes
+
+
+class LRUCache:
+    """Least recently used cache of a limited size that counts its hits and misses.
+    
+    Attributes:
+        maxsize (int): Maximal number of cached entries, 0 disables caching
+        hits (int): Number of lookups that found a cached entry
+        misses (int): Number of lookups that didn't find a cached entry
+    """
+
+    def __init__(self, maxsize=128):
+        """Creates an empty cache.
+        
+        Args:
+            maxsize (int, optional): Maximal number of cached entries, 0 disables caching
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, compute):
+        """Returns the cached value of the key, computing and caching it if it isn't cached.
+        
+        Args:
+            key (Hashable): The key
+            compute (function): A function() -> Any that computes the value
+        
+        Returns:
+            Any: The value
+        """
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        self.misses += 1
+        value = compute()
+        if self.maxsize > 0:
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def resize(self, maxsize):
+        """Changes the maximal number of entries, dropping the least recently used ones if needed.
+        
+        Args:
+            maxsize (int): Maximal number of cached entries, 0 disables caching
+        """
+        self.maxsize = maxsize
+        while len(self._entries) > max(maxsize, 0):
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Removes every entry and resets the counters.
+        """
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """Returns the cache statistics.
+        
+        Returns:
+            dict: Number of hits, misses, cached entries and the maximal number of entries
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+# Results of cached_best_pick_by_pos and cached_adv_matrix
+suggestion_cache = LRUCache()
+
+
+def meta_version(meta_heroes):
+    """Creates a hashable version of meta heroes, which changes whenever the heroes (or their order) change.
+    
+    Args:
+        meta_heroes (list[list[tuple(int, float)]]): List of best heroes (their ID and win rate) for each position
+    
+    Returns:
+        tuple: IDs of heroes for each position
+    """
+    return tuple(tuple(hero for hero, win_rate in heroes) for heroes in meta_heroes)
+
+
+def cached_best_pick_by_pos(meta_heroes, hero_matchups, radiant_heroes, dire_heroes, is_radiant=True, pos=None):
+    """Same as get_best_pick_by_pos, but results are cached in suggestion_cache for the same picks (in any order), side, positions,
+    match up data and meta heroes. The returned lists are shared between calls and must not be modified.
+    
+    Args:
+        meta_heroes (list[list[tuple(int, float)]]): List of best heroes (their ID and win rate) for each position
+        hero_matchups (dict): Match up matrices (obtained through build_matchup_matrices function)
+        radiant_heroes (list[int]): List of hero indexes for radiant
+        dire_heroes (list[int]): List of hero indexes for dire
+        is_radiant (bool, optional): Determines if picking for radiant side
+        pos (list[int], optional): List of positions to consider, by default includes all positions (1-5)
+    
+    Returns:
+        list[list[tuple(int, float, float, float)]]: ID, avg counter, avg synergy, averaged value for each hero for each position
+    """
+    allies = radiant_heroes if is_radiant else dire_heroes
+    enemies = dire_heroes if is_radiant else radiant_heroes
+    key = ('picks', frozenset(allies), frozenset(enemies), is_radiant, tuple(pos) if pos else None,
+           hero_matchups['version'], meta_version(meta_heroes))
+    return suggestion_cache.get(key, lambda: get_best_pick_by_pos(meta_heroes, hero_matchups, radiant_heroes, dire_heroes,
+                                                                  is_radiant, pos))
+
+
+def cached_adv_matrix(radiant_heroes, dire_heroes, hero_matchups):
+    """Same as calc_adv_matrix, but results are cached in suggestion_cache for the same picks and match up data. Heroes are kept in
+    their order, since it determines the rows and columns of the matrices. The returned lists must not be modified.
+    
+    Args:
+        radiant_heroes (list[int]): List of hero indexes for radiant
+        dire_heroes (list[int]): List of hero indexes for dire
+        hero_matchups (dict): Match up matrices (obtained through build_matchup_matrices function)
+    
+    Returns:
+        tuple(list, list, list): 3 matrices (counters, synergy for radiant, synergy for dire)
+    """
+    key = ('grid', tuple(radiant_heroes), tuple(dire_heroes), hero_matchups['version'])
+    return suggestion_cache.get(key, lambda: calc_adv_matrix(radiant_heroes, dire_heroes, hero_matchups))
@@ -0,0 +1,153 @@
+import argparse
+import asyncio
+import json
+import random
+from aiohttp import web
+from pathlib import Path
+
+import queries
+
+
+def field_key(text):
+    """Normalizes the whitespace of a field's text, so fields formatted differently share their recorded result.
+    
+    Args:
+        text (str): Field including its arguments and selection (see queries.split_query_fields function)
+    
+    Returns:
+        str: Key of the field in a recording
+    """
+    return ' '.join(text.split())
+
+
+class Recording:
+    """Stratz query results saved field by field, so a batch query can be replayed even if it combines the fields differently than
+    the recorded ones. Results are appended to a JSON lines file as they are recorded.
+    
+    Attributes:
+        path (Path): Path to the recording file
+        fields (dict{str: json}): Result of each recorded top level field, by the field's text without whitespace differences
+    """
+
+    def __init__(self, path):
+        """Creates an empty recording, see load function for reading a recorded one.
+        
+        Args:
+            path (str): Path to the recording file
+        """
+        self.path = Path(path)
+        self.fields = {}
+
+    def load(self):
+        """Reads the recording file, later results of a field replace earlier ones.
+        
+        Returns:
+            Recording: The recording itself
+        """
+        with open(self.path, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.fields[entry['field']] = entry['data']
+        return self
+
+    def record(self, query, data):
+        """Saves the result of a query.
+        
+        Args:
+            query (str): Query string passed to GraphQL API
+            data (json): Data of the query result
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as fp:
+            for key, name, text in queries.split_query_fields(query):
+                field = field_key(text)
+                self.fields[field] = data[key]
+                fp.write(json.dumps({'field': field, 'data': data[key]}, separators=(',', ':')) + '\n')
+
+    def replay(self, query):
+        """Gets the recorded result of a query.
+        
+        Args:
+            query (str): Query string passed to GraphQL API
+        
+        Returns:
+            json: Data of the query result
+        
+        Raises:
+            KeyError: Error indicating some field of the query wasn't recorded
+        """
+        return {key: self.fields[field_key(text)] for key, name, text in queries.split_query_fields(query)}
+
+
+def make_app(recording, latency=0, jitter=0, error_rate=0, seed=None):
+    """Creates a web application answering GraphQL requests with recorded results, in place of the Stratz API.
+    
+    Args:
+        recording (Recording): Recorded query results
+        latency (float, optional): Delay in seconds before each response
+        jitter (float, optional): Maximal random delay in seconds added to the latency
+        error_rate (float, optional): Probability (0-1) of answering a request with a server error
+        seed (int, optional): Seed of the random delays and errors, so runs can be repeated
+    
+    Returns:
+        aiohttp.web.Application: The application
+    """
+    rng = random.Random(seed)
+
+    async def graphql(request):
+        query = (await request.json())['query']
+        await asyncio.sleep(latency + rng.uniform(0, jitter))
+        if rng.random() < error_rate:
+            return web.json_response({'errors': [{'message': 'Injected error'}]}, status=503)
+        try:
+            return web.json_response({'data': recording.replay(query)})
+        except KeyError as e:
+            return web.json_response({'errors': [{'message': f'Field not recorded: {e.args[0]}'}]}, status=404)
+        except queries.Error as e:
+            return web.json_response({'errors': [{'message': e.args[0]}]}, status=400)
+
+    app = web.Application()
+    app.router.add_post('/graphql', graphql)
+    return app
+
+
+async def start_server(recording, host='127.0.0.1', port=0, **options):
+    """Starts the replay server in the running event loop.
+    
+    Args:
+        recording (Recording): Recorded query results
+        host (str, optional): Address the server listens on
+        port (int, optional): Port the server listens on, 0 picks a free one
+        **options: Keyword arguments passed to make_app function (latency, jitter, error_rate, seed)
+    
+    Returns:
+        tuple(aiohttp.web.AppRunner, str): The runner (its cleanup function stops the server) and the URL of the GraphQL API
+    """
+    runner = web.AppRunner(make_app(recording, **options))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    host, port = runner.addresses[0][:2]
+    return runner, f'http://{host}:{port}/graphql'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays recorded Stratz query results (see "mode" in config.json) on a local GraphQL API.')
+    parser.add_argument('recording', nargs='?', default=str(Path(__file__).resolve().with_name('stratz_recording.jsonl')),
+                        help='recording file, by default the one recorded by hero-picker.py')
+    parser.add_argument('--host', default='127.0.0.1', help='address the server listens on')
+    parser.add_argument('--port', type=int, default=8080, help='port the server listens on')
+    parser.add_argument('--latency', type=float, default=0, help='delay in seconds before each response')
+    parser.add_argument('--jitter', type=float, default=0, help='maximal random delay in seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0, help='probability (0-1) of answering with a server error')
+    parser.add_argument('--seed', type=int, help='seed of the random delays and errors')
+    args = parser.parse_args()
+
+    recording = Recording(args.recording).load()
+    print(f'Replaying {len(recording.fields)} fields on http://{args.host}:{args.port}/graphql')
+    web.run_app(make_app(recording, args.latency, args.jitter, args.error_rate, args.seed), host=args.host, port=args.port,
+                print=None)
+
+
+if __name__ == '__main__':
+    main()